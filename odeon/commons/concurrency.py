@@ -0,0 +1,46 @@
+"""
+Module of helpers to run I/O bound functions (file opening, listing, writing)
+concurrently. GDAL and file I/O release the GIL, so threads are used.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_IO_WORKERS = 8
+
+
+def thread_map(function, items, *args, max_workers=MAX_IO_WORKERS):
+    """
+    Apply a function on each item of a list with a pool of threads.
+    Less than two items are processed in the calling thread.
+
+    Parameters
+    ----------
+    function : callable
+     function called as function(item, *args)
+    items : iterable
+     items to process
+    args
+     additional arguments of the function
+    max_workers : int, optional
+     maximum number of threads, by default MAX_IO_WORKERS
+
+    Returns
+    -------
+    list
+     the results, in the order of items
+
+    Raises
+    -------
+    Exception
+     the exception of the first failing item, in the order of items,
+     the items not started yet are cancelled
+    """
+
+    items = list(items)
+
+    if len(items) < 2:
+
+        return [function(item, *args) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+
+        return list(executor.map(lambda item: function(item, *args), items))
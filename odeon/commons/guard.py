@@ -7,10 +7,43 @@ import fiona
 from odeon.commons.exception import ErrorCodes, OdeonError
 from fiona import supported_drivers
 import os
+from collections import Counter
+from odeon.commons.concurrency import thread_map
 from odeon import LOGGER
 
-RASTER_DRIVER_ACCEPTED = ["GTiff", "GeoTIFF", "VRT"]
-FIONA_DRIVER_ACCEPTED = supported_drivers.keys()
+RASTER_DRIVER_ACCEPTED = frozenset(("GTiff", "GeoTIFF", "VRT"))
+FIONA_DRIVER_ACCEPTED = frozenset(supported_drivers.keys())
+" a directory is listed once when this many of its entries are checked, else they are checked one by one "
+MIN_ENTRIES_TO_LIST = 16
+
+
+def run_checks(check, items, *args):
+    """
+    Run a check function on each item of a list. The checks open files and
+    GDAL releases the GIL during I/O, so they are run by a pool of threads.
+
+    Parameters
+    ----------
+    check : callable
+     check function called as check(item, *args)
+    items : list
+     items to check
+    args
+     additional arguments of the check function
+
+    Returns
+    -------
+    None
+
+    Raises
+    -------
+    odeon.commons.exception.OdeonError
+     the error of the first failing item, in the order of items
+    """
+
+    # errors are raised in the order of items, so the reported error doesn't depend on
+    # which check finishes first
+    thread_map(check, items, *args)
 
 
 def geo_projection_raster_guard(raster):
@@ -42,14 +75,7 @@ def geo_projection_raster_guard(raster):
                                      f"the crs {src.crs} of raster {raster} is empty")
         else:
 
-            for file in raster:
-
-                with rasterio.open(file) as src:
-
-                    if src.crs == "" or src.crs is None:
-
-                        raise OdeonError(ErrorCodes.ERR_COORDINATE_REFERENCE_SYSTEM,
-                                         f"the crs {src.crs} of raster {file} is empty")
+            run_checks(geo_projection_raster_guard, raster)
 
     except rasterio.errors.RasterioError as rioe:
 
@@ -95,24 +121,7 @@ def geo_projection_vector_guard(vector):
 
     else:
 
-        for v in vector:
-
-            try:
-
-                LOGGER.debug(v)
-                with fiona.open(v) as src:
-
-                    if isinstance(v, str):
-
-                        if src.crs == "" or src.crs is None:
-
-                            raise OdeonError(ErrorCodes.ERR_COORDINATE_REFERENCE_SYSTEM,
-                                             f"the crs {src.crs} of vector {v} is empty")
-
-            except fiona._err.CPLE_AppDefinedError as error:
-
-                raise OdeonError(ErrorCodes.ERR_COORDINATE_REFERENCE_SYSTEM,
-                                 f"the crs {src.crs} of vector {vector} has an encoding problem", stack_trace=error)
+        run_checks(geo_projection_vector_guard, vector)
 
 
 def vector_driver_guard(vector):
@@ -143,14 +152,7 @@ def vector_driver_guard(vector):
                                  f" {vector} is not accepted in Odeon")
     else:
 
-        for v in vector:
-
-            with fiona.open(v) as src:
-
-                if src.driver not in FIONA_DRIVER_ACCEPTED:
-                    raise OdeonError(ErrorCodes.ERR_DRIVER_COMPATIBILITY,
-                                     f"the driver {src.driver} of mask file"
-                                     f" {v} is not accepted in Odeon")
+        run_checks(vector_driver_guard, vector)
 
 
 def raster_driver_guard(raster):
@@ -182,14 +184,7 @@ def raster_driver_guard(raster):
                                      f" {raster} is not accepted in Odeon")
         else:
 
-            for r in raster:
-
-                with rasterio.open(r) as src:
-
-                    if src.driver not in RASTER_DRIVER_ACCEPTED:
-                        raise OdeonError(ErrorCodes.ERR_DRIVER_COMPATIBILITY,
-                                         f"the driver {src.driver} of raster file"
-                                         f" {r} is not accepted in Odeon")
+            run_checks(raster_driver_guard, raster)
 
     except rasterio.errors.RasterioError as rioe:
 
@@ -202,8 +197,210 @@ def raster_driver_guard(raster):
                          f"Odeon encountered an error during raster opening {raster}", stack_trace=rioe)
 
 
+def validate_raster(raster, accepted_drivers=None, required_bands=None):
+    """
+    Check the crs, and optionally the driver and the bands, of a raster
+    by opening it only once.
+
+    Parameters
+    ----------
+    raster : str
+     file path of raster
+    accepted_drivers : Union[list, set], optional
+     drivers accepted for the raster, by default None (driver not checked)
+    required_bands : list, optional
+     indices of band which must exist in the raster, by default None
+
+    Returns
+    -------
+    None
+
+    Raises
+    -------
+    odeon.commons.exception.OdeonError
+     error code ERR_COORDINATE_REFERENCE_SYSTEM, ERR_DRIVER_COMPATIBILITY,
+     ERR_RASTER_BAND_NOT_EXIST or ERR_IO
+    """
+    try:
+
+        with rasterio.open(raster) as src:
+
+            if src.crs == "" or src.crs is None:
+
+                raise OdeonError(ErrorCodes.ERR_COORDINATE_REFERENCE_SYSTEM,
+                                 f"the crs {src.crs} of raster {raster} is empty")
+
+            if accepted_drivers is not None and src.driver not in accepted_drivers:
+
+                raise OdeonError(ErrorCodes.ERR_DRIVER_COMPATIBILITY,
+                                 f"the driver {src.driver} of raster file"
+                                 f" {raster} is not accepted in Odeon")
+
+            for band in required_bands if required_bands is not None else []:
+
+                if band > src.count:
+                    raise OdeonError(ErrorCodes.ERR_RASTER_BAND_NOT_EXIST,
+                                     f"the band {band} from raster {raster} "
+                                     f"doesn't exists")
+
+    except rasterio.errors.RasterioError as rioe:
+
+        raise OdeonError(ErrorCodes.ERR_IO,
+                         f"Odeon encountered an error during raster opening {raster}", stack_trace=rioe)
+
+
+def validate_rasters(raster, accepted_drivers=None, required_bands=None):
+    """
+    Merge of geo_projection_raster_guard, raster_driver_guard and raster_bands_exist,
+    each raster is opened once for all the checks.
+
+    Parameters
+    ----------
+    raster : Union[str, list]
+     file path of raster or list of file path
+    accepted_drivers : Union[list, set], optional
+     drivers accepted for the raster, by default None (driver not checked)
+    required_bands : list, optional
+     indices of band which must exist in each raster, by default None
+
+    Returns
+    -------
+    None
+
+    Raises
+    -------
+    odeon.commons.exception.OdeonError
+     see validate_raster
+    """
+
+    run_checks(validate_raster, [raster] if isinstance(raster, str) else raster, accepted_drivers, required_bands)
+
+
+def validate_vector(vector, accepted_drivers=FIONA_DRIVER_ACCEPTED):
+    """
+    Check the crs and the driver of a vector by opening it only once.
+
+    Parameters
+    ----------
+    vector : str
+     file path of vector
+    accepted_drivers : Union[list, set], optional
+     drivers accepted for the vector, by default FIONA_DRIVER_ACCEPTED
+
+    Returns
+    -------
+    None
+
+    Raises
+    -------
+    odeon.commons.exception.OdeonError
+     error code ERR_COORDINATE_REFERENCE_SYSTEM or ERR_DRIVER_COMPATIBILITY
+    """
+    LOGGER.debug(vector)
+    try:
+
+        with fiona.open(vector) as src:
+
+            if src.crs == "" or src.crs is None:
+
+                raise OdeonError(ErrorCodes.ERR_COORDINATE_REFERENCE_SYSTEM,
+                                 f"the crs {src.crs} of vector {vector} is empty")
+
+            if accepted_drivers is not None and src.driver not in accepted_drivers:
+
+                raise OdeonError(ErrorCodes.ERR_DRIVER_COMPATIBILITY,
+                                 f"the driver {src.driver} of mask file"
+                                 f" {vector} is not accepted in Odeon")
+
+    except fiona._err.CPLE_AppDefinedError as error:
+
+        raise OdeonError(ErrorCodes.ERR_COORDINATE_REFERENCE_SYSTEM,
+                         f"the crs of vector {vector} has an encoding problem", stack_trace=error)
+
+
+def validate_vectors(vector, accepted_drivers=FIONA_DRIVER_ACCEPTED):
+    """
+    Merge of geo_projection_vector_guard and vector_driver_guard,
+    each vector is opened once for all the checks.
+
+    Parameters
+    ----------
+    vector : Union[str, list]
+     file path of vector or list of file path
+    accepted_drivers : Union[list, set], optional
+     drivers accepted for the vector, by default FIONA_DRIVER_ACCEPTED
+
+    Returns
+    -------
+    None
+
+    Raises
+    -------
+    odeon.commons.exception.OdeonError
+     see validate_vector
+    """
+
+    run_checks(validate_vector, [vector] if isinstance(vector, str) else vector, accepted_drivers)
+
+
+def list_dir_entries(dir_name):
+    """
+
+    Parameters
+    ----------
+    dir_name : str
+     path of a directory, the current directory if empty
+
+    Returns
+    -------
+    Union[dict, None]
+     entry names of the directory with True as value if the entry is a file,
+     False if it's a directory, None otherwise. None if the directory can't be listed
+     (missing, or traversable but not readable), its entries must then be checked one by one.
+    """
+
+    try:
+
+        with os.scandir(dir_name or os.curdir) as entries:
+
+            return {entry.name: True if entry.is_file() else (False if entry.is_dir() else None)
+                    for entry in entries}
+
+    except OSError:
+
+        return None
+
+
+def list_dirs_entries(dir_names):
+    """
+    Apply list_dir_entries with a pool of threads on the directories with at least
+    MIN_ENTRIES_TO_LIST entries to check. Listing a large directory for a few
+    entries is slower than checking them one by one.
+
+    Parameters
+    ----------
+    dir_names : list
+     directory of each entry to check, with repetitions
+
+    Returns
+    -------
+    dict
+     the result of list_dir_entries for each directory, None for the directories
+     not listed
+    """
+
+    counts = Counter(dir_names)
+    listed = [dir_name for dir_name, count in counts.items() if count >= MIN_ENTRIES_TO_LIST]
+    listings = dict.fromkeys(counts)
+    listings.update(zip(listed, thread_map(list_dir_entries, listed)))
+
+    return listings
+
+
 def files_exist(list_of_file):
     """
+    Directories with many files to check are listed once with a single scandir,
+    instead of one stat per file.
 
     Parameters
     ----------
@@ -219,27 +416,27 @@ def files_exist(list_of_file):
 
     """
 
-    for element in list_of_file:
-
-        if isinstance(element, str):
+    file_names = [file_name for element in list_of_file
+                  for file_name in ([element] if isinstance(element, str) else element)]
+    listings = list_dirs_entries([os.path.dirname(file_name) for file_name in file_names])
 
-            if os.path.isfile(element) is not True:
+    for file_name in file_names:
 
-                raise OdeonError(ErrorCodes.ERR_FILE_NOT_EXIST,
-                                 f"the file {element} doesn't exists")
-
-        else:
+        dir_name, base_name = os.path.split(file_name)
+        listing = listings[dir_name]
 
-            for sub_element in element:
+        exists = os.path.isfile(file_name) if listing is None else listing.get(base_name) is True
 
-                if os.path.isfile(sub_element) is not True:
+        if not exists:
 
-                    raise OdeonError(ErrorCodes.ERR_FILE_NOT_EXIST,
-                                     f"the file {sub_element} doesn't exists")
+            raise OdeonError(ErrorCodes.ERR_FILE_NOT_EXIST,
+                             f"the file {file_name} doesn't exists")
 
 
 def dirs_exist(list_of_dir):
     """
+    Parent directories with many directories to check are listed once with a single scandir,
+    instead of one stat per directory.
 
     Parameters
     ----------
@@ -255,9 +452,22 @@ def dirs_exist(list_of_dir):
 
     """
 
-    for dir_name in list_of_dir:
+    splits = [os.path.split(os.path.normpath(dir_name)) for dir_name in list_of_dir]
+    listings = list_dirs_entries([parent_name for parent_name, _ in splits])
 
-        if os.path.isdir(dir_name) is not True:
+    for dir_name, (parent_name, base_name) in zip(list_of_dir, splits):
+
+        if base_name in ["", os.curdir, os.pardir] or listings[parent_name] is None:
+
+            # root, current or parent directory are not listed by scandir,
+            # and the parent directory may not be listed or listable
+            exists = os.path.isdir(dir_name)
+
+        else:
+
+            exists = listings[parent_name].get(base_name) is False
+
+        if exists is not True:
             raise OdeonError(ErrorCodes.ERR_DIR_NOT_EXIST,
                              f"the dir {dir_name} doesn't exists")
 
@@ -329,18 +539,7 @@ def raster_bands_exist(raster, list_of_band):
                                          f"doesn't exists")
         else:
 
-            for r in raster:
-
-                with rasterio.open(r) as src:
-
-                    bands_count = src.count
-
-                    for band in list_of_band:
-
-                        if band > bands_count:
-                            raise OdeonError(ErrorCodes.ERR_RASTER_BAND_NOT_EXIST,
-                                             f"the band {band} from raster {r} "
-                                             f"doesn't exists")
+            run_checks(raster_bands_exist, raster, list_of_band)
 
     except rasterio.errors.RasterioError as rioe:
 
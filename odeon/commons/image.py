@@ -1,3 +1,5 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import rasterio
 from math import isclose
@@ -6,9 +8,13 @@ import rasterio.transform
 import rasterio.windows
 from rasterio.plot import reshape_as_image, reshape_as_raster
 from skimage import img_as_float
-from odeon.commons.rasterio import get_bounds, create_patch_from_center
+from odeon.commons.rasterio import get_bounds, create_patch_from_center, ndarray_to_affine  # noqa: F401
+from odeon.commons.kernels import compute_dem
+from odeon.commons.concurrency import MAX_IO_WORKERS
 from odeon import LOGGER
 
+READ_POOLS = {}
+
 
 def raster_to_ndarray_from_dataset(
         src, width, height, resolution=None, band_indices=None, resampling=Resampling.bilinear,
@@ -32,6 +38,9 @@ def raster_to_ndarray_from_dataset(
         list of band indices to be loaded in output image, by default None (native image bands are used)
     resampling: one enum from rasterio.Reampling
         resampling method to use when a resolution change is necessary.
+        When the output is coarser than the source, GDAL reads from the closest
+        overview of the source if it has some, so rasters with overviews are
+        decimated without being read at full resolution.
         Default: Resampling.bilinear
     window: rasterio.window, see rasterio docs
         use a window in rasterio format or not to select a subsection of the raster
@@ -74,10 +83,18 @@ def raster_to_ndarray_from_dataset(
 
         left, right = get_dim_bounds(width, resolution[0], left, right)
         bottom, top = get_dim_bounds(height, resolution[1], bottom, top)
-        window = rasterio.windows.from_bounds(left, bottom, right, top, src.meta["transform"])
+        window = rasterio.windows.from_bounds(left, bottom, right, top, src.transform)
 
     else:
-        left, bottom, right, top = rasterio.windows.bounds(window, src.meta["transform"])
+        left, bottom, right, top = rasterio.windows.bounds(window, src.transform)
+
+    # a window on the pixel grid of the source and of the output size needs no
+    # interpolation, nearest gives the same pixels without the filtering cost.
+    if (abs(window.width - width) < 1e-4 and abs(window.height - height) < 1e-4
+            and abs(window.col_off - round(window.col_off)) < 1e-4
+            and abs(window.row_off - round(window.row_off)) < 1e-4):
+
+        resampling = Resampling.nearest
 
     img = src.read(
         indexes=band_indices, window=window, out_shape=(len(band_indices), height, width),
@@ -89,7 +106,8 @@ def raster_to_ndarray_from_dataset(
     if img.ndim == 2:
         img = img[..., np.newaxis]
 
-    meta = src.meta.copy()
+    # src.meta builds a new dict on each access, no copy is needed
+    meta = src.meta
     LOGGER.debug(meta)
     affine = rasterio.transform.from_bounds(left, bottom, right, top, width, height)
     meta["transform"] = affine
@@ -273,18 +291,17 @@ class TypeConverter:
 
             elif self._to == "uint8":
 
-                if img.max() > 1:
+                if np.issubdtype(img.dtype, np.integer):
 
-                    info = np.idebug(img.dtype)  # Get the information of the incoming image type
+                    info = np.iinfo(img.dtype)  # Get the information of the incoming image type
                     img = img.astype(np.float32) / info.max  # normalize the data to 0 - 1
 
-                img = 255 * img  # scale by 255
+                img = np.rint(255 * img)  # scale by 255
                 return img.astype(np.uint8)
 
             elif self._to == "bit":
 
-                img = img > threshold
-                return img.astype(np.uint8)
+                return np.greater(img, threshold).view(np.uint8)
 
             else:
 
@@ -292,18 +309,57 @@ class TypeConverter:
                 return img
 
 
-def ndarray_to_affine(affine):
-    """
+def convert_to_dtype(img, dtype):
+    """Convert an image to an integer data type, values are scaled from the range
+    of the image (its type range for an integer image, [0, 1] for a float image)
+    to the range of the output type, rounded, and clipped to the output type range.
+    An image already of the output type is returned as is.
 
     Parameters
     ----------
-    affine : numpy Array
+    img : NDArray
+        image to convert
+    dtype : Union[str, numpy.dtype]
+        output integer type
+
+    Returns
+    -------
+    NDArray
+        the converted image
+    """
+
+    dtype = np.dtype(dtype)
+
+    if img.dtype == dtype:
+
+        return img
+
+    info = np.iinfo(dtype)
+    scale = info.max if img.dtype.kind == "f" else info.max / np.iinfo(img.dtype).max
+    scaled = np.multiply(img, np.float32(scale), dtype=np.float32)
+    np.rint(scaled, out=scaled)
+    # float values out of [0, 1] would wrap around in the cast
+    np.clip(scaled, info.min, info.max, out=scaled)
+
+    return scaled.astype(dtype)
+
+
+def get_read_pool():
+    """Return the thread pool used to read the rasters of a collection concurrently.
+    The pool is created once per process, so forked workers (DataLoader) get their own.
 
     Returns
     -------
-    rasterio.Affine
+    concurrent.futures.ThreadPoolExecutor
     """
-    return rasterio.Affine(affine[0], affine[1], affine[2], affine[3], affine[4], affine[5])
+
+    pid = os.getpid()
+
+    if pid not in READ_POOLS:
+
+        READ_POOLS[pid] = ThreadPoolExecutor(max_workers=MAX_IO_WORKERS)
+
+    return READ_POOLS[pid]
 
 
 class CollectionDatasetReader:
@@ -321,7 +377,8 @@ class CollectionDatasetReader:
                                       height,
                                       resolution,
                                       dem=False,
-                                      resampling=Resampling.bilinear):
+                                      resampling=Resampling.bilinear,
+                                      dtype=None):
         """Stack multiple raster band in one raster, with a specific output format and resolution
         and output bounds. It can handle the DEM = DSM - DTM computation if the dict of raster
         band includes a band called "DTM" and a band called "DSM", but you must set the dem parameter
@@ -349,6 +406,10 @@ class CollectionDatasetReader:
         resampling: one enum from rasterio.Reampling
             resampling method to use when a resolution change is necessary.
             Default: Resampling.bilinear
+        dtype: str, optional
+            integer output type, the bands are scaled to the range of this type, and
+            the bands of rasters already of this type are stacked as read.
+            Default: None, the bands are normalized to [0, 1] floats
 
         Returns
         -------
@@ -356,68 +417,68 @@ class CollectionDatasetReader:
             the stacked raster
         """
         handle_dem = False
-        stacked_bands = None
 
         if "DSM" in dict_of_raster.keys() and "DTM" in dict_of_raster.keys() and dem is True:
             handle_dem = True
 
-        for key, value in dict_of_raster.items():
-            if (key not in ["DSM", "DTM"]) or handle_dem is False:
-                src = value["connection"]
-                window = rasterio.windows.from_bounds(
-                    bounds[0], bounds[1], bounds[2], bounds[3], src.meta["transform"])
-                band_indices = value["bands"]
-                img, _ = raster_to_ndarray_from_dataset(src,
-                                                        width,
-                                                        height,
-                                                        resolution,
-                                                        band_indices=band_indices,
-                                                        resampling=resampling,
-                                                        window=window)
+        def read_window(src, band_indices):
+
+            window = rasterio.windows.from_bounds(
+                bounds[0], bounds[1], bounds[2], bounds[3], src.transform)
+            img, _ = raster_to_ndarray_from_dataset(src,
+                                                    width,
+                                                    height,
+                                                    resolution,
+                                                    band_indices=band_indices,
+                                                    resampling=resampling,
+                                                    window=window)
+            return img
+
+        def read_layer(value):
 
-                # pixels are normalized to [0, 1]
-                img = img_as_float(img)
+            img = read_window(value["connection"], value["bands"])
 
-                LOGGER.debug(f"type of img: {type(img)}, shape {img.shape}")
+            # pixels are normalized to [0, 1], or to the range of the output type
+            return img_as_float(img) if dtype is None else convert_to_dtype(img, dtype)
 
-                stacked_bands = img if stacked_bands is None else np.dstack([stacked_bands, img])
-                LOGGER.debug(f"type of stacked bands: {type(stacked_bands)}, shape {stacked_bands.shape}")
+        values = [value for key, value in dict_of_raster.items()
+                  if (key not in ["DSM", "DTM"]) or handle_dem is False]
+
+        # each raster has its own dataset connection and rasterio releases the GIL
+        # while reading, so the windows of the different rasters are read concurrently.
+        pool = get_read_pool()
 
         if handle_dem:
-            dsm_ds = dict_of_raster["DSM"]["connection"]
-            dtm_ds = dict_of_raster["DTM"]["connection"]
-            dsm_window = rasterio.windows.from_bounds(
-                bounds[0], bounds[1], bounds[2], bounds[3], dsm_ds.meta["transform"])
-            dtm_window = rasterio.windows.from_bounds(
-                bounds[0], bounds[1], bounds[2], bounds[3], dtm_ds.meta["transform"])
+
+            # DSM and DTM are both read with the DSM bands, at the same time as the other rasters
             band_indices = dict_of_raster["DSM"]["bands"]
+            dem_futures = [pool.submit(read_window, dict_of_raster[key]["connection"], band_indices)
+                           for key in ["DSM", "DTM"]]
 
-            dsm_img, _ = raster_to_ndarray_from_dataset(dsm_ds,
-                                                        width,
-                                                        height,
-                                                        resolution,
-                                                        band_indices=band_indices,
-                                                        resampling=resampling,
-                                                        window=dsm_window)
-
-            dtm_img, _ = raster_to_ndarray_from_dataset(dtm_ds,
-                                                        width,
-                                                        height,
-                                                        resolution,
-                                                        band_indices=band_indices,
-                                                        resampling=resampling,
-                                                        window=dtm_window)
-
-            # raw dem = dsm - dtm
-            img = dsm_img - dtm_img
-            # LOGGER.debug(img.sum())
-            # dsm should not be under dtm theorically but this could happen
-            # due to product specification (rounding) etc.. so add check
-            mne_msk = dtm_img > dsm_img
-            img[mne_msk] = 0
+        if len(values) > 1 or handle_dem:
+
+            imgs = pool.map(read_layer, values)
+
+        else:
+
+            imgs = map(read_layer, values)
+
+        imgs = list(imgs)
+
+        if handle_dem:
+
+            dsm_img, dtm_img = [future.result() for future in dem_futures]
+
+            # raw dem = dsm - dtm, computed in floating point so integer
+            # elevation models can not wrap around.
             # scaling to vertical resolution such that it should be ok when convert
-            # to uint8
-            img *= 5  # empircally chosen factor
+            # to uint8 (empircally chosen factor of 5), then normalize to [0, 1].
+            # as input are float img_as_float could not be used for normalization.
+            # dsm should not be under dtm theorically but this could happen
+            # due to product specification (rounding) etc.. so the low pass filter
+            # sets them to 0, and the high pass filter caps the dem at 255 / 255.
+            # all of it is done in a single pass by the dem kernel.
+            img = compute_dem(dsm_img, dtm_img, 5 / 255)
 
             # probably a wrong thing to do.. resolution[0] and 1 are x and y resolution
             # and not min/max elevation
@@ -425,18 +486,21 @@ class CollectionDatasetReader:
             # img[img < xmin] = xmin  # low pass filter
             # img[img > xmax] = xmax  # high pass filter
 
-            # low pass filer, should not do anatyhing as we should
-            # already have only positives values.
-            img[img < 0] = 0
-            # high pass filter.
-            img[img > 255] = 255
+            if dtype is not None:
+
+                img = convert_to_dtype(img, dtype)
 
-            # normalize to [0, 1]. as input are float img_as_float could not be used for
-            # normalization.
-            img = img / 255
             # LOGGER.debug(f"img min: {img.min()}, img max: {img.max()}, img shape: {img.shape}")
-            stacked_bands = img if stacked_bands is None else np.dstack([stacked_bands, img])
-            LOGGER.debug(f"type of stacked bands: {type(stacked_bands)}, shape {stacked_bands.shape}")
+            imgs.append(img)
+
+        if not imgs:
+
+            return None
+
+        # the output is allocated and filled once, instead of growing it
+        # with a new stack (and a copy of the previous bands) per raster
+        stacked_bands = imgs[0] if len(imgs) == 1 else np.dstack(imgs)
+        LOGGER.debug(f"type of stacked bands: {type(stacked_bands)}, shape {stacked_bands.shape}")
 
         return stacked_bands
 
@@ -454,8 +518,9 @@ class CollectionDatasetReader:
 
         Parameters
         ----------
-        center : pandas.core.series.Series
-            a row from a pandas DataFrame
+        center : Center
+            a row from a pandas DataFrame as a namedtuple (DataFrame.itertuples)
+            with at least the x, y, img_file and msk_file fields
         dict_of_raster : dict[str, str]
             dictionary of layer geo tif (RGB, CIR, etc.)
         meta : dict
@@ -464,8 +529,10 @@ class CollectionDatasetReader:
             rather calculate or not DMS - DMT and create a new band with it
         compute_only_masks : int (0,1)
             rather compute only masks or not
-        raster_out: str
-            path of rasterized full mask where to extract the window mask
+        raster_out: Union[str, rasterio.DatasetReader, InMemoryRaster]
+            path of rasterized full mask where to extract the window mask, or
+            its dataset opened once for all the patches, or an
+            :class:`odeon.commons.rasterio.InMemoryRaster` when it fits in memory
         meta_msk: dict
             metadata in rasterio format for raster mask
         output_type: str
@@ -495,7 +562,7 @@ class CollectionDatasetReader:
         meta_msk_patch["transform"] = rasterio.windows.transform(window, meta_msk['transform'])
 
         # Creation of masks tiles from an input window.
-        create_patch_from_center(center["msk_file"],
+        create_patch_from_center(center.msk_file,
                                  raster_out,
                                  meta_msk_patch,
                                  window,
@@ -508,8 +575,9 @@ class CollectionDatasetReader:
                                                                         meta_img_patch['height'],
                                                                         meta_img_patch['resolution'],
                                                                         dem,
-                                                                        resampling=resampling)
-            raster_img = (reshape_as_raster(img) * 255).astype(output_type)
+                                                                        resampling=resampling,
+                                                                        dtype=output_type)
+            raster_img = reshape_as_raster(img)
 
-            with rasterio.open(center["img_file"], 'w', **meta_img_patch) as dst:
+            with rasterio.open(center.img_file, 'w', **meta_img_patch) as dst:
                 dst.write(raster_img)
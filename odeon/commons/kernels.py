@@ -0,0 +1,71 @@
+"""Pixel kernels
+
+Per pixel computations of the patch pipelines. They are compiled with numba
+when it is installed, and fall back on numpy ufuncs otherwise.
+
+"""
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ModuleNotFoundError:
+    njit = None
+
+
+def compute_dem_numpy(dsm, dtm, scale, out):
+    """numpy version of compute_dem, in place in out"""
+
+    np.subtract(dsm, dtm, out=out, dtype=np.float32)
+    np.multiply(out, np.float32(scale), out=out)
+    np.clip(out, 0, 1, out=out)
+
+    return out
+
+
+if njit is not None:
+
+    # no fastmath, it assumes there is no NaN and elevation models can have NaN nodata
+    @njit(parallel=True, cache=True)
+    def compute_dem_numba(dsm, dtm, scale, out):
+        """numba version of compute_dem, on flat arrays, in place in out"""
+
+        for i in prange(out.size):
+
+            value = (np.float32(dsm[i]) - np.float32(dtm[i])) * scale
+            out[i] = min(max(value, np.float32(0)), np.float32(1))
+
+        return out
+
+else:
+
+    compute_dem_numba = None
+
+
+def compute_dem(dsm, dtm, scale):
+    """Compute the normalized height band: (dsm - dtm) * scale, clipped to [0, 1],
+    in a single pass over the pixels.
+
+    Parameters
+    ----------
+    dsm : NDArray
+        digital surface model
+    dtm : NDArray
+        digital terrain model, of the shape of dsm
+    scale : float
+        factor applied to the heights
+
+    Returns
+    -------
+    NDArray
+        float32 height band of the shape of dsm
+    """
+
+    out = np.empty(dsm.shape, dtype=np.float32)
+
+    if compute_dem_numba is None:
+
+        return compute_dem_numpy(dsm, dtm, scale, out)
+
+    compute_dem_numba(np.ravel(dsm), np.ravel(dtm), np.float32(scale), out.reshape(-1))
+
+    return out
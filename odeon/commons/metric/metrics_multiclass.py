@@ -432,8 +432,9 @@ class MetricsMulticlass(Metrics):
             df_roc_pr_values.to_csv(path_roc_csv, index=False)
 
         if self.output_type == 'json':
-            self.dict_export['cm micro'] = self.cm_micro.tolist()
-            self.dict_export['cm macro'] = self.cm_macro.tolist()
+            # arrays are serialized as is by the json report
+            self.dict_export['cm micro'] = self.cm_micro
+            self.dict_export['cm macro'] = self.cm_macro
             self.dict_export['report macro'] = self.df_report_macro.T.to_dict()
             self.dict_export['report micro'] = self.df_report_micro.T.to_dict()
             self.dict_export['report classes'] = self.df_report_classes.T.to_dict()
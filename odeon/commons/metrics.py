@@ -1,3 +1,4 @@
+from functools import lru_cache
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -56,28 +57,13 @@ def binarizes(detection, threshold=0.5, multilabel=False):
     no_of_class = detection.shape[1]
     if no_of_class == 1 or multilabel:  # Monoclass or multilabel
         assert threshold is not None
-        tmp = detection.copy()
-        tmp[detection > threshold] = 1
-        tmp[detection <= threshold] = 0
-        return tmp.copy()
+        return (detection > threshold).astype(detection.dtype)
     else:  # Multiclass monolabel
 
         labels = np.argmax(detection, axis=1)
-        cl = np.arange(no_of_class)
-        v_other = no_of_class + 1
-        result = []
-
-        for c in np.nditer(cl):
-
-            tmp = labels.copy()
-            tmp[tmp != c] = v_other
-            tmp[tmp == c] = 1
-            tmp[tmp == v_other] = 0
-            result.append(tmp.copy())
-
-        result = np.array(result)
-        result = result.swapaxes(0, 1)
-        return result
+        # one hot encoding of all the classes in a single broadcasted comparison
+        cl = np.arange(no_of_class).reshape((1, no_of_class) + (1,) * (labels.ndim - 1))
+        return (np.expand_dims(labels, 1) == cl).astype(labels.dtype)
 
 
 def get_confusion_matrix(predictions, target, multilabel=False):
@@ -119,14 +105,44 @@ def get_confusion_matrix(predictions, target, multilabel=False):
         # from (N,W,H,C) to (N,C,W,H) tensor
         labels_masks = labels_masks.permute(0, 3, 1, 2).cpu().numpy()
 
-    cl = np.arange(n_classes)
-    cms = np.zeros((2, 2), dtype=np.uint64)
-    for c in np.nditer(cl):
-        target = mask[:, c, :, :].flatten()
-        prediction = labels_masks[:, c, :, :].flatten()
-        cms = cms + get_binary_confusion_matrix(prediction, target)
+    # the sum of the binary confusion matrices of each class is the binary
+    # confusion matrix of all the classes at once.
+    return get_binary_confusion_matrix(labels_masks.ravel(), mask.ravel()).astype(np.uint64)
+
+
+def encode_confusion_pairs(predictions: torch.Tensor, target: torch.Tensor, num_class: int) -> torch.Tensor:
+    """Encode each (prediction, target) couple of classes as a single value
+    num_class * prediction + target, see :func:`get_confusion_matrix_torch`
+
+    Scripted on first use by :func:`get_confusion_matrix_torch`, so the argmax,
+    flatten and encoding run as a single graph without python dispatch between
+    the kernels.
+
+    Parameters
+    ----------
+    predictions : torch tensor of dim N,C,W,H
+        predictions (probabilities or logits)
+    target : torch tensor of dim N,C,W,H (one hot) or N,W,H (class indices)
+        labels
+    num_class : int
+        number of classes
+
+    Returns
+    -------
+    torch tensor
+        flat tensor of the encoded couples
+    """
+    preds = predictions.argmax(1).reshape(-1)
+    if target.dim() == predictions.dim():
+        target = target.argmax(1)
+    return num_class * preds + target.reshape(-1).long()
+
 
-    return cms
+@lru_cache(maxsize=None)
+def scripted_encode_confusion_pairs():
+    """Script :func:`encode_confusion_pairs` once, when a confusion matrix is
+    first computed instead of when the module is imported"""
+    return torch.jit.script(encode_confusion_pairs)
 
 
 def get_confusion_matrix_torch(predictions, target, multilabel=False, cuda=False, threshold=0.5):
@@ -143,8 +159,8 @@ def get_confusion_matrix_torch(predictions, target, multilabel=False, cuda=False
     ----------
     predictions : torch tensor of dim N,C,W,H (float)
         predictions
-    target : torch tensor of dim N,C,W,H (long)
-        labels
+    target : torch tensor of dim N,C,W,H (one hot) or N,W,H (class indices)
+        labels, class indices are only accepted in multiclass case (no multilabel)
     multilabel : bool, optional
         activate multilabel mode, by default False
     cude : bool, optional
@@ -161,9 +177,8 @@ def get_confusion_matrix_torch(predictions, target, multilabel=False, cuda=False
     pred_detach = predictions.detach()
     target_detach = target.detach()
     if not multilabel and num_class > 1:
-        # predictions and target are transformed from one-hot to int with argmax
-        preds_cm = pred_detach.argmax(1).view(-1)
-        target_cm = target_detach.argmax(1).view(-1)  # so no multilabel here
+        # predictions and one-hot target are transformed to int with argmax
+        # (so no multilabel here), see encode_confusion_pairs
         # the trick to speed up torch computation of confusion matrix is to
         # transform the problem to only use optimized functions of torch (GPU/ or
         # parallelize on cpu).
@@ -193,16 +208,10 @@ def get_confusion_matrix_torch(predictions, target, multilabel=False, cuda=False
         #
         # transform of (pred, target) couple in unique value using a base N
         # encoding
-        y = num_class * preds_cm + target_cm
+        y = scripted_encode_confusion_pairs()(pred_detach, target_detach, num_class)
         # compute histogramm of each possible unique value (each possible couple pred/target)
-        y = torch.bincount(y)
-        # as output of bincout is of len max(y) if not all class exists in current
-        # batch we need to pad with zero values (by concatenation)
-        if len(y) < num_class * num_class:
-            y_comp = torch.zeros(num_class * num_class - len(y), dtype=torch.long)
-            if cuda:
-                y_comp = y_comp.cuda()
-            y = torch.cat([y, y_comp])
+        # minlength pads the classes missing from the current batch with zero values
+        y = torch.bincount(y, minlength=num_class * num_class)
         # finally we reshape 1D array to 2D confusion matrix
         y = y.reshape(num_class, num_class)
     else:
@@ -222,9 +231,8 @@ def get_confusion_matrix_torch(predictions, target, multilabel=False, cuda=False
         tn = target_reshaped.shape[1] - tp - fp - fn
 
         # reshape result as num_class, 2, 2 tensor
+        # computed on the device of the inputs, the result stays there
         y = torch.stack([tp, fp, fn, tn], dim=1).reshape(-1, 2, 2)
-        if cuda:
-            y.cuda()
 
     return y
 
@@ -249,10 +257,11 @@ def get_binary_confusion_matrix(prediction, target):
         confusion matrix [[TP,FN],[FP,TN]]
     """
 
-    tp = np.sum(np.logical_and(target, prediction))
-    tn = np.sum(np.logical_not(np.logical_or(target, prediction)))
-    fp = np.sum(prediction[target == 0] == 1)
-    fn = np.sum(prediction[target == 1] == 0)
+    # counts are derived from the totals, without boolean indexing copies
+    tp = np.count_nonzero(np.logical_and(target, prediction))
+    fp = np.count_nonzero(prediction) - tp
+    fn = np.count_nonzero(target) - tp
+    tn = target.size - tp - fp - fn
 
     return np.array([[tp, fn], [fp, tn]])
 
@@ -1,11 +1,23 @@
+from typing import NamedTuple
 import numpy as np
 import rasterio
 from rasterio import features
+from odeon.commons.concurrency import thread_map
 from odeon import LOGGER
 
+
+class ImageType(NamedTuple):
+    """rank (to order the types), value range, numpy and rasterio types of a patch data type"""
+    rank: int
+    min_value: int
+    max_value: int
+    np_dtype: type
+    rio_dtype: str
+
+
 IMAGE_TYPE = {
-                "uint8": [0, 0, 2**8 - 1, np.uint8, rasterio.uint8],
-                "uint16": [1, 0, 2**16 - 1, np.uint16, rasterio.uint16]
+                "uint8": ImageType(0, 0, 2**8 - 1, np.uint8, rasterio.uint8),
+                "uint16": ImageType(1, 0, 2**16 - 1, np.uint16, rasterio.uint16)
 }
 
 
@@ -39,8 +51,8 @@ def get_window_param(center, dataset, width, height):
 
     Parameters
     ----------
-    center : pandas.core.series.Series
-     a row from a pandas DataFrame
+    center : Union[pandas.core.series.Series, Center]
+     a row from a pandas DataFrame, or its namedtuple (DataFrame.itertuples)
     dataset : rasterio.DatasetReader
      a Rasterio Dataset to get the row, col from x, y in GeoCoordinate
      this is where we will extract path
@@ -100,7 +112,8 @@ def create_patch_from_center(out_file, msk_raster, meta, window, resampling):
     Parameters
     ----------
     out_file: str
-    msk_raster : tif of raster
+    msk_raster : Union[str, rasterio.DatasetReader, InMemoryRaster]
+     tif of raster, or its dataset already opened (or read in memory) to be reused between patches
     meta : dict
      geo metadata in gdal format
     window : rasterio.window.Window
@@ -113,29 +126,48 @@ def create_patch_from_center(out_file, msk_raster, meta, window, resampling):
 
     """
 
-    with rasterio.open(msk_raster) as dst:
+    if isinstance(msk_raster, str):
+
+        with rasterio.open(msk_raster) as dst:
+
+            return create_patch_from_center(out_file, dst, meta, window, resampling)
+
+    # all the bands of the window are read at once, and only once
+    out = msk_raster.read(window=window, out_shape=(meta["count"], meta["height"], meta["width"]),
+                          resampling=resampling)
+
+    # building the no label band in place of the last band
+    np.logical_not(np.any(out[:-1], axis=0), out=out[-1], casting="unsafe")
+
+    with rasterio.open(out_file, 'w', **meta) as raster_out:
+
+        raster_out.write(out)
+
+    return window
+
 
-        clip = dst.read(window=window, out_shape=(meta["count"], meta["height"], meta["width"]), resampling=resampling)
-        # building the no label band
+def get_metas(paths):
+    """Read the metadata of a list of rasters, each raster being
+    opened once, concurrently (GDAL releases the GIL while opening)
 
-        bands = clip[0:clip.shape[0]-1].astype(np.bool).astype(np.uint8).copy()
-        other_band = np.sum(bands, axis=0, dtype=np.uint8)
-        other_band = (other_band == 0).astype(np.uint8)
+    Parameters
+    ----------
+    paths : list[str]
+     raster file paths
+
+    Returns
+    -------
+    list[dict]
+     rasterio metadata of each raster, in the order of paths
+    """
 
-        with rasterio.open(out_file, 'w', **meta) as raster_out:
+    def read_meta(path):
 
-            # raster_out.write(clip)
-            # LOGGER.info(np.array([other_band]).shape)
-            # LOGGER.info(clip[0:clip.shape[0]-1].shape)
+        with rasterio.open(path) as src:
 
-            out = dst.read(window=window,
-                           out_shape=(meta["count"], meta["height"], meta["width"]),
-                           resampling=resampling)
-            out = np.vstack((out[0:out.shape[0]-1], np.array([other_band])))
-            # LOGGER.debug(out.shape)
-            raster_out.write(out)
+            return src.meta
 
-        return window
+    return thread_map(read_meta, paths)
 
 
 def check_proj(dict_of_raster):
@@ -152,21 +184,9 @@ def check_proj(dict_of_raster):
      True if all rasters have same crs
     """
 
-    check = True
-    crs_compare = None
-
-    for raster_name, raster in dict_of_raster.items():
-
-        with rasterio.open(raster) as src:
-
-            crs = src.meta["crs"]
-            crs_compare = crs if crs_compare is None else crs_compare
+    crss = [meta["crs"] for meta in get_metas(list(dict_of_raster.values()))]
 
-            if crs_compare != crs:
-
-                check = False
-
-    return check
+    return all(crs == crss[0] for crs in crss)
 
 
 def count_band_for_stacking(dict_of_raster):
@@ -182,22 +202,18 @@ def count_band_for_stacking(dict_of_raster):
     int
     """
 
-    nb_of_necessary_band = 0
-    rasters: dict = dict_of_raster.copy()
-
-    if ("DSM" and "DTM") in rasters:
+    has_height = "DSM" in dict_of_raster and "DTM" in dict_of_raster
+    nb_of_necessary_band = 1 if has_height else 0
 
-        nb_of_necessary_band += 1
+    for raster_name, raster in dict_of_raster.items():
 
-    rasters.pop("DSM", None)
-    rasters.pop("DTM", None)
+        if has_height and raster_name in ("DSM", "DTM"):
 
-    for raster_name, raster in rasters.items():
+            continue
 
         with rasterio.open(raster) as src:
 
-            count = src.meta["count"]
-            nb_of_necessary_band += count
+            nb_of_necessary_band += src.count
 
     return nb_of_necessary_band
 
@@ -248,17 +264,17 @@ def get_max_type(rasters):
     """
 
     dtype = "uint8"
+    rank = IMAGE_TYPE[dtype].rank
+    paths = [r for raster in rasters.values() for r in raster["path"]]
 
-    for name, raster in rasters.items():
-
-        for r in raster["path"]:
+    for path, meta in zip(paths, get_metas(paths)):
 
-            with rasterio.open(r) as src:
+        LOGGER.debug(f"raster: {path}, type: {meta['dtype']}")
+        image_type = IMAGE_TYPE.get(meta["dtype"])
 
-                LOGGER.debug(f"raster: {raster}, type: {src.meta['dtype']}")
-                if src.meta["dtype"] in IMAGE_TYPE.keys() and IMAGE_TYPE[src.meta["dtype"]][0] > IMAGE_TYPE[dtype][0]:
+        if image_type is not None and image_type.rank > rank:
 
-                    dtype = src.meta["dtype"]
+            dtype, rank = meta["dtype"], image_type.rank
 
     LOGGER.debug(f"dtype: {dtype}")
     return dtype
@@ -368,3 +384,50 @@ class RIODatasetCollection:
 
             self.collection[key].close()
             del self.collection[key]
+
+
+class InMemoryRaster:
+    """A raster dataset read once in memory. Windows on its pixel grid, read
+    without resampling, are sliced from the array, the other reads go to the dataset.
+
+    Parameters
+    ----------
+    dataset : rasterio.DatasetReader
+        opened dataset, it stays owned (and closed) by the caller
+    """
+
+    def __init__(self, dataset):
+
+        self.dataset = dataset
+        self.array = dataset.read()
+
+    def read(self, window, out_shape, resampling):
+        """Read a window like rasterio.DatasetReader.read
+
+        Parameters
+        ----------
+        window : rasterio.windows.Window
+        out_shape : tuple
+            (count, height, width) of the output
+        resampling : rasterio.enums.Resampling
+
+        Returns
+        -------
+        NDArray
+            the window, a copy the caller can modify
+        """
+
+        col_off, row_off = round(window.col_off), round(window.row_off)
+        count, height, width = out_shape
+
+        if (count == self.array.shape[0]
+                and all(abs(value - target) < 1e-4 for value, target in [(window.width, width),
+                                                                         (window.height, height),
+                                                                         (window.col_off, col_off),
+                                                                         (window.row_off, row_off)])
+                and 0 <= row_off and row_off + height <= self.array.shape[1]
+                and 0 <= col_off and col_off + width <= self.array.shape[2]):
+
+            return self.array[:, row_off:row_off + height, col_off:col_off + width].copy()
+
+        return self.dataset.read(window=window, out_shape=out_shape, resampling=resampling)
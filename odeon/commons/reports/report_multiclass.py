@@ -1,5 +1,10 @@
 import os.path as osp
 import json
+import numpy as np
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
 from odeon.commons.reports.report import Report
 from odeon.commons.metric.plots import plot_norm_and_value_cms, plot_confusion_matrix,\
      plot_calibration_curves, plot_roc_pr_curves
@@ -61,10 +66,29 @@ class Report_Multiclass(Report):
         """Create a report in the json format.
         """
         dict_export = self.input_object.dict_export
-        json_object = json.dumps(dict_export, indent=4)
-        with open(osp.join(self.output_path, 'report_metrics.json'), "w") as output_file:
+
+        if orjson is not None:
+
+            # orjson serializes numpy arrays natively, without boxing every value
+            json_object = orjson.dumps(dict_export,
+                                       option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+                                       | orjson.OPT_INDENT_2)
+
+        else:
+
+            json_object = json.dumps(dict_export, indent=4, default=self.to_json_type).encode()
+
+        with open(osp.join(self.output_path, 'report_metrics.json'), "wb") as output_file:
             output_file.write(json_object)
 
+    @staticmethod
+    def to_json_type(value):
+        """Convert the numpy arrays and scalars the json module can not serialize.
+        """
+        if isinstance(value, (np.ndarray, np.generic)):
+            return value.tolist()
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
     def to_md(self):
         """Create a report in the markdown format.
         """
@@ -126,18 +150,18 @@ class Report_Multiclass(Report):
 
 ### Per class strategy
 """
-        class_histograms = []
-        for class_name in self.input_object.class_labels:
-            class_html = f"""
+            class_histograms = []
+            for class_name in self.input_object.class_labels:
+                class_html = f"""
 #### {class_name.capitalize()}:
 ![Histograms {class_name}](./{osp.basename(self.path_hists[class_name])})"""
-            class_histograms.append(class_html)
+                class_histograms.append(class_html)
 
-        md_elements.append(metrics_histograms + "\n".join(class_histograms))
+            md_elements.append(metrics_histograms + "\n".join(class_histograms))
 
+        # the report is assembled once and written in a single call
         with open(osp.join(self.output_path, 'multiclass_metrics.md'), "w") as output_file:
-            for md_element in md_elements:
-                output_file.write(md_element)
+            output_file.write("".join(md_elements))
 
     def to_html(self):
         """Create a report in the html format.
@@ -235,6 +259,6 @@ class Report_Multiclass(Report):
 
         html_elements.append(end_html)
 
+        # the report is assembled once and written in a single call
         with open(osp.join(self.output_path, 'metrics_multiclass.html'), "w") as output_file:
-            for html_part in html_elements:
-                output_file.write(html_part)
+            output_file.write("".join(html_elements))
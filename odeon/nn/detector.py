@@ -4,6 +4,7 @@ module of Detection jobs
 import os
 import math
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from torch.utils.data import DataLoader
 import torch.nn.functional as F
@@ -16,8 +17,8 @@ from odeon.nn.datasets import PatchDetectionDataset, ZoneDetectionDataset
 from odeon.nn.models import load_model
 from odeon.commons.exception import OdeonError, ErrorCodes
 from odeon import LOGGER
-from odeon.commons.rasterio import ndarray_to_affine, RIODatasetCollection
-from odeon.commons.image import TypeConverter, substract_margin
+from odeon.commons.rasterio import RIODatasetCollection
+from odeon.commons.image import substract_margin
 from odeon.commons.shape import create_polygon_from_bounds
 from odeon.commons.folder_manager import create_folder
 NB_PROCESSOR = multiprocessing.cpu_count()
@@ -64,6 +65,8 @@ class BaseDetector:
         self.job = job
         self.data_loader = None
         self.dataset = None
+        self.host_buffers = [None, None]
+        self.host_buffer_index = 0
         self.model = load_model(
             self.model_name,
             self.model_path,
@@ -90,6 +93,8 @@ class BaseDetector:
                     affines = samples["affine"].cpu().numpy()
                     self.save(predictions, indices, affines)
 
+                self.flush()
+
             except KeyboardInterrupt as error:
 
                 LOGGER.warning("the job has been prematurely interrupted")
@@ -105,6 +110,7 @@ class BaseDetector:
 
             finally:
 
+                self.close()
                 self.job.save_job()
                 LOGGER.debug("the detection job has been saved")
 
@@ -137,6 +143,16 @@ class BaseDetector:
 
         # predictions
 
+        use_softmax = self.model.n_classes > 1 and self.mutual_exclusion is True
+
+        if self.output_type == "bit" and not use_softmax and 0 < self.threshold < 1:
+
+            # sigmoid is monotonic: sigmoid(x) > t is x > logit(t), so the
+            # probabilities are not computed when only the binary mask is written
+            logit_threshold = math.log(self.threshold / (1 - self.threshold))
+
+            return self.to_host((logits > logit_threshold).to(torch.uint8))
+
         if self.model.n_classes == 1:
 
             predictions = torch.sigmoid(logits)
@@ -151,14 +167,68 @@ class BaseDetector:
 
                 predictions = torch.sigmoid(logits)
 
-        predictions = predictions.cpu().numpy()
+        # conversion to the output type is done before the copy to host
+        # memory to transfer 4 times less data for uint8 and bit outputs.
+        if self.output_type == "uint8":
+
+            predictions = predictions.clamp_(0, 1).mul_(255).round_().to(torch.uint8)
+
+        elif self.output_type == "bit":
+
+            predictions = (predictions > self.threshold).to(torch.uint8)
+
+        return self.to_host(predictions)
+
+    def to_host(self, predictions):
+        """Copy the predictions to host memory as a numpy array
+
+        On GPU, the copy is done asynchronously into persistent pinned buffers.
+        Two buffers are used alternately as the arrays of a batch may still be
+        read while the next batch is detected.
+
+        Parameters
+        ----------
+        predictions : torch.Tensor
+
+        Returns
+        -------
+        NDArray
+        """
+
+        if not predictions.is_cuda:
+
+            return predictions.numpy()
+
+        n_samples = predictions.shape[0]
+        buffer = self.host_buffers[self.host_buffer_index]
 
-        return predictions
+        if buffer is None or buffer.dtype != predictions.dtype or buffer.shape[1:] != predictions.shape[1:] \
+                or buffer.shape[0] < n_samples:
+
+            buffer = torch.empty((max(self.batch_size, n_samples), *predictions.shape[1:]),
+                                 dtype=predictions.dtype,
+                                 pin_memory=True)
+            self.host_buffers[self.host_buffer_index] = buffer
+
+        self.host_buffer_index = 1 - self.host_buffer_index
+        host_predictions = buffer[:n_samples]
+        host_predictions.copy_(predictions, non_blocking=True)
+        torch.cuda.current_stream().synchronize()
+
+        return host_predictions.numpy()
 
     def save(self, predictions, indices, affines):
 
         pass
 
+    def flush(self):
+
+        pass
+
+    def close(self):
+
+        pass
+
 
 class PatchDetector(BaseDetector):
 
@@ -211,21 +281,32 @@ class PatchDetector(BaseDetector):
         self.job = job
         self.num_thread = num_thread
         self.num_worker = num_worker
-        self.gdal_options = {"compress": "LZW",
-                             "tiled": True,
-                             "blockxsize": self.img_size_pixel,
-                             "blockysize": self.img_size_pixel,
-                             "SPARSE_MODE": self.sparse_mode}
+        # patches are written as Cloud Optimized GeoTIFF, one block per patch.
+        # the COG driver takes BLOCKSIZE (not BLOCKXSIZE/BLOCKYSIZE) and LEVEL
+        # for the ZSTD level, PREDICTOR=YES picks the predictor from the dtype.
+        # no NUM_THREADS: patches are compressed in parallel by the write pool and
+        # a single block can't be split between compression threads anyway.
+        self.driver = "COG"
+        self.gdal_options = {"COMPRESS": "ZSTD",
+                             "LEVEL": 1,
+                             "PREDICTOR": "YES",
+                             "BLOCKSIZE": self.img_size_pixel,
+                             "SPARSE_OK": "TRUE" if self.sparse_mode else "FALSE",
+                             "BIGTIFF": "IF_SAFER"}
 
         if self.output_type == "bit":
 
             self.gdal_options["bit"] = 1
 
+        self.meta_template = None
+        self.write_pool = None
+        self.pending_writes = []
+
     def configure(self):
 
         LOGGER.debug(len(self.job))
         self.meta = self.get_meta(self.job.get_cell_at(0, "img_file"))
-        self.meta["driver"] = "GTiff"
+        self.meta["driver"] = self.driver
         self.meta["dtype"] = "uint8" if self.output_type in ["uint8", "bit"] else "float32"
         self.meta["count"] = self.n_classes
         self.meta["transform"], _, _ = aligned_target(self.meta["transform"],
@@ -234,6 +315,9 @@ class PatchDetector(BaseDetector):
                                                       self.resolution)
         self.meta["width"] = self.img_size_pixel
         self.meta["height"] = self.img_size_pixel
+        # creation options shared by every patch, only the transform changes
+        self.meta_template = {key: value for key, value in {**self.meta, **self.gdal_options}.items()
+                              if key != "transform"}
         self.dataset = PatchDetectionDataset(self.job,
                                              height=self.img_size_pixel,
                                              width=self.img_size_pixel,
@@ -248,6 +332,10 @@ class PatchDetector(BaseDetector):
                                       num_workers=self.num_worker,
                                       pin_memory=True
                                       )
+        # rasterio releases the GIL while writing, so patches are written
+        # by a pool of threads while the next batch is detected.
+        self.close()
+        self.write_pool = ThreadPoolExecutor(max_workers=max(1, NB_PROCESSOR // 2))
 
     @classmethod
     def get_meta(cls, file):
@@ -257,21 +345,47 @@ class PatchDetector(BaseDetector):
             return src.meta.copy()
 
     def save(self, predictions, indices, affines):
+        """Submit the writing of the predictions to the write pool.
+        The writes of the previous batch are waited for first, so they overlap
+        with the detection of the current batch.
+        """
+
+        self.flush()
 
-        for prediction, index, affine in zip(predictions, indices, affines):
+        # affines are converted once for the whole batch
+        transforms = [rasterio.Affine(*affine[:6]) for affine in affines.tolist()]
+
+        for prediction, index, affine, transform in zip(predictions, indices, affines, transforms):
 
             LOGGER.debug(index)
             output_file = self.job.get_cell_at(index[0], "img_output_file")
             self.job.set_cell_at(index[0], "transform", affine)
-            self.meta["transform"] = ndarray_to_affine(affine)
 
-            with rasterio.open(output_file, "w", **self.meta, **self.gdal_options) as src:
+            future = self.write_pool.submit(self.write_one, prediction, output_file, transform)
+            self.pending_writes.append((index[0], future))
+
+    def write_one(self, prediction, output_file, transform):
+
+        with rasterio.open(output_file, "w", transform=transform, **self.meta_template) as src:
+
+            src.write(prediction.astype(self.meta["dtype"], copy=False))
+
+    def flush(self):
 
-                converter = TypeConverter()
-                prediction = converter.from_type("float32").to_type(self.output_type).convert(prediction,
-                                                                                              threshold=self.threshold)
-                src.write(prediction)
-                self.job.set_cell_at(index[0], "job_done", True)
+        for index, future in self.pending_writes:
+
+            future.result()
+            self.job.set_cell_at(index, "job_done", True)
+
+        self.pending_writes = []
+
+    def close(self):
+        """Shut the write pool down once its pending writes are done"""
+
+        if self.write_pool is not None:
+
+            self.write_pool.shutdown(wait=True)
+            self.write_pool = None
 
 
 class ZoneDetector(PatchDetector):
@@ -331,7 +445,24 @@ class ZoneDetector(PatchDetector):
         self.dem = dem
         self.output_write = os.path.join(self.output_path, "result")
         create_folder(self.output_write)
-        self.gdal_options["BIGTIFF"] = "YES"
+        # output tiles are updated window by window (w+ mode), which the COG
+        # driver can not do, so they stay plain tiled GeoTIFF.
+        self.driver = "GTiff"
+        self.gdal_options = {"compress": "ZSTD",
+                             "zstd_level": 1,
+                             "predictor": 2 if self.output_type in ["uint8", "bit"] else 3,
+                             "num_threads": "ALL_CPUS",
+                             "BIGTIFF": "YES",
+                             "tiled": True,
+                             "interleave": "band",
+                             "blockxsize": self.img_size_pixel,
+                             "blockysize": self.img_size_pixel,
+                             "SPARSE_MODE": self.sparse_mode}
+
+        if self.output_type == "bit":
+
+            self.gdal_options["bit"] = 1
+
         self.dst = None
         self.meta_output = None
         self.out_dalle_size = out_dalle_size
@@ -345,7 +476,7 @@ class ZoneDetector(PatchDetector):
 
         self.dst = rasterio.open(next(iter(self.dict_of_raster.values()))["path"])
         self.meta = self.dst.meta.copy()
-        self.meta["driver"] = "GTiff"
+        self.meta["driver"] = self.driver
         self.meta["dtype"] = "uint8" if self.output_type in ["uint8", "bit"] else "float32"
         self.meta["count"] = self.n_classes
 
@@ -370,9 +501,6 @@ class ZoneDetector(PatchDetector):
             # LOGGER.info(prediction.shape)
             prediction = substract_margin(prediction, self.margin_zone, self.margin_zone)
             prediction = reshape_as_raster(prediction)
-            converter = TypeConverter()
-            prediction = converter.from_type("float32").to_type(self.output_type).convert(prediction,
-                                                                                          threshold=self.threshold)
 
             output_id = self.job.get_cell_at(index[0], "output_id")
             LOGGER.debug(output_id)
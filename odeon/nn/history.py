@@ -1,5 +1,9 @@
 import json
 import numpy as np
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
 import matplotlib
 import matplotlib.pyplot as plt
 
@@ -37,14 +41,37 @@ class History:
 
             try:
 
-                with open(self.history_file, 'r') as file:
-                    self.history_dict = json.load(file)
+                self.load(self.history_file)
 
-            except OdeonError as error:
+            except (OSError, ValueError) as error:
+                # json and orjson decode errors are both ValueError
                 raise OdeonError(ErrorCodes.ERR_FILE_NOT_EXIST,
-                                 f"{self.history_file} not found",
+                                 f"{self.history_file} not found or not readable",
                                  stack_trace=error)
 
+    @property
+    def train_iou(self):
+        """True if train iou values are stored, a loaded history keeps the keys it was saved with"""
+        return 'train_mean_iou' in self.history_dict
+
+    def load(self, history_file):
+        """load history dict from a json file
+
+        Parameters
+        ----------
+        history_file : str
+        """
+        # orjson, when available, parses the numeric heavy history much faster
+        if orjson is not None:
+
+            with open(history_file, 'rb') as file:
+                self.history_dict = orjson.loads(file.read())
+
+        else:
+
+            with open(history_file, 'r') as file:
+                self.history_dict = json.load(file)
+
     def get_current_epoch(self, default=None):
         epochs = self.history_dict['epoch']
         return default if not epochs else epochs[-1]
@@ -83,8 +110,6 @@ class History:
         train_loss = np.array(self.history_dict['train_loss'])
         val_loss = np.array(self.history_dict['val_loss'])
         val_miou = np.array(self.history_dict['val_mean_iou'])
-        if 'train_mean_iou' in self.history_dict:
-            train_miou = np.array(self.history_dict['train_mean_iou'])
 
         # Loss
         plt.figure(1)
@@ -100,12 +125,10 @@ class History:
 
         plt.figure(2)
 
-        if 'train_mean_iou' in self.history_dict:
-            t, = plt.plot(train_miou, 'b')
         v, = plt.plot(val_miou, 'g')
 
-        if 'train_mean_iou' in self.history_dict:
-            t, = plt.plot(train_miou, 'b')
+        if self.train_iou:
+            t, = plt.plot(np.array(self.history_dict['train_mean_iou']), 'b')
             plt.legend((t, v), ('train', 'validation'), loc='upper left')
         else:
             plt.legend((v,), ('validation',), loc='upper left')
@@ -44,7 +44,8 @@ class BCEWithLogitsLoss(nn.Module):
 
 class CrossEntropyWithLogitsLoss(nn.Module):
     """Cross entropy loss with logits
-    Labels are flattened using argmax function and CrossEntropyLoss uses a LogSoftmax function.
+    One hot labels are flattened using argmax function and CrossEntropyLoss uses a LogSoftmax function.
+    Labels of class indices (without channel dimension) are used as is.
 
     Parameters
     ----------
@@ -60,10 +61,12 @@ class CrossEntropyWithLogitsLoss(nn.Module):
         self.cross_entropy = nn.CrossEntropyLoss(weight, reduction=reduction)
 
     def forward(self, logits, targets):
-        # flatten masks to get rid of channel dimension
-        # force/cast target tensor to long
-        targets = torch.argmax(targets.long(), dim=1)
-        return self.cross_entropy(logits, targets)
+        # flatten one hot masks to get rid of channel dimension, argmax already
+        # returns long indices so the one hot mask is not cast
+        if targets.dim() == logits.dim():
+            targets = torch.argmax(targets, dim=1)
+        # class indices are cast to long as expected by CrossEntropyLoss
+        return self.cross_entropy(logits, targets.long())
 
 
 class ComboLoss(nn.Module):
@@ -298,6 +301,18 @@ class LovaszLoss(nn.Module):
 
 
 class FocalLoss2d(nn.Module):
+    """Binary focal loss with logits
+
+    The loss is computed in float32, also under autocast, and its element-wise
+    operations are fused when the module is scripted with :func:`torch.jit.script`.
+
+    Parameters
+    ----------
+    gamma : int, optional
+        focusing parameter, by default 2
+    ignore_index : int, optional
+        target value of the ignored pixels, by default 255
+    """
 
     def __init__(self, gamma=2, ignore_index=255):
 
@@ -307,7 +322,8 @@ class FocalLoss2d(nn.Module):
 
     def forward(self, logits, targets):
 
-        outputs = torch.sigmoid(logits)
+        # eps clamping is lost in half precision
+        outputs = torch.sigmoid(logits.float())
         outputs = outputs.contiguous()
         targets = targets.contiguous()
         eps = 1e-8
@@ -1,15 +1,25 @@
+import inspect
+import io
 import os
 from pathlib import Path
 import torch
+from torch.utils.checkpoint import checkpoint
 from odeon.nn.unet import UNet, UNetResNet, LightUNet
 from odeon.nn.deeplabv3p import DeeplabV3p
 from odeon.commons.exception import OdeonError, ErrorCodes
+from odeon.commons.concurrency import thread_map
 
 model_list = [
     "unet", "lightunet",
     "resnet18", "resnet34", "resnet50", "resnet101", "resnet150",
     "deeplab"
 ]
+# pytorch >= 2.1 can use the loaded tensors as parameters instead of copying them
+ASSIGN_STATE_DICT = "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+# pytorch >= 2.1 can memory map saved states, with restricted unpickling (weights_only)
+MMAP_LOAD = "mmap" in inspect.signature(torch.load).parameters
+# encoder blocks of the models (UNet and LightUNet, UNetResNet, DeeplabV3p) for gradient checkpointing
+ENCODER_BLOCKS = ["inc", "down1", "down2", "down3", "down4", "conv1", "conv2", "conv3", "conv4", "conv5", "backbone"]
 
 
 def build_model(model_name, n_channels, n_classes, load_pretrained=False):
@@ -48,6 +58,49 @@ def build_model(model_name, n_channels, n_classes, load_pretrained=False):
     return net
 
 
+def enable_gradient_checkpointing(model, block_names=None):
+    """Activate gradient checkpointing on the encoder blocks of a model
+
+    The activations of the blocks are not kept for the backward pass but
+    computed again, which trades about a third more compute for half the
+    activation memory, so larger batches fit on the GPU.
+    The forward method of the blocks is replaced, parameter names are unchanged.
+
+    The forward pass computed again in the backward pass runs in training mode,
+    so the batch normalization running statistics of the blocks are updated twice
+    with the same batch: they move as with a momentum of about 0.19 instead of 0.1.
+    The weights and the gradients are not affected.
+
+    Parameters
+    ----------
+    model : nn.Module
+        odeon/pytorch model
+    block_names : list of str, optional
+        names of the blocks to checkpoint, by default None (ENCODER_BLOCKS)
+
+    Returns
+    -------
+    nn.Module
+        the model
+    """
+
+    def checkpointed(forward):
+
+        def checkpoint_forward(*args):
+            if torch.is_grad_enabled():
+                return checkpoint(forward, *args, use_reentrant=False)
+            return forward(*args)
+
+        return checkpoint_forward
+
+    for name in block_names if block_names is not None else ENCODER_BLOCKS:
+        block = getattr(model, name, None)
+        if isinstance(block, torch.nn.Module):
+            block.forward = checkpointed(block.forward)
+
+    return model
+
+
 def get_train_filenames(out_dir, out_filename):
     """
     return dict of path used to save training info
@@ -102,7 +155,7 @@ def get_train_filenames(out_dir, out_filename):
         "history": history_file}
 
 
-def load_model(model_name, model_path, n_channel, n_classes, use_gpu=False):
+def load_model(model_name, model_path, n_channel, n_classes, use_gpu=False, device=None):
     """load model from a model name and models files
 
     Parameters
@@ -120,6 +173,8 @@ def load_model(model_name, model_path, n_channel, n_classes, use_gpu=False):
         number of classes in the output mask
     use_gpu : bool, optional
         load the model to gpu (training mode) or not (detect on cpu)
+    device : str, optional
+        device where the model is loaded, overrides use_gpu, by default None
 
     Returns
     -------
@@ -135,23 +190,53 @@ def load_model(model_name, model_path, n_channel, n_classes, use_gpu=False):
 
     model = build_model(model_name, n_channel, n_classes)
 
-    if use_gpu:
+    if device is None:
 
-        model.cuda()
-        state_dict = torch.load(model_path)
-        model.load_state_dict(state_dict=state_dict)
+        device = 'cuda' if use_gpu else 'cpu'
+
+    # the state is loaded directly on the target device
+    state_dict = load_state(model_path, map_location=torch.device(device))
+
+    if ASSIGN_STATE_DICT:
+
+        # the loaded tensors replace the initial parameters, without a second copy
+        model.load_state_dict(state_dict=state_dict, strict=True, assign=True)
+        model.to(device)
 
     else:
 
-        model.cpu()
-        state_dict = torch.load(model_path,
-                                map_location=torch.device('cpu'))
-        # LOGGER.debug(state_dict.keys())
+        model.to(device)
         model.load_state_dict(state_dict=state_dict)
 
     return model
 
 
+def load_state(file_path, map_location=None):
+    """load a state dict saved with torch.save
+
+    The file is memory mapped, so only the storages actually used are read,
+    and unpickling is restricted to tensors and primitive types.
+    Versions of pytorch older than 2.1 (no mmap argument) fall back to a plain load.
+
+    Parameters
+    ----------
+    file_path : str
+        path of the saved state
+    map_location : str or torch.device, optional
+        device where the tensors are loaded, by default None (device at saving time)
+
+    Returns
+    -------
+    dict
+        the loaded state
+    """
+    if MMAP_LOAD:
+
+        return torch.load(file_path, map_location=map_location, mmap=True, weights_only=True)
+
+    return torch.load(file_path, map_location=map_location)
+
+
 def save_model(out_dir, out_filename, model, optimizer=None, scheduler=None, train_dict=None):
     """
     save a model and optionaly it's training info
@@ -179,21 +264,84 @@ def save_model(out_dir, out_filename, model, optimizer=None, scheduler=None, tra
     :str:
         path to the saved model
     """
+    buffers = dump_train_state(out_dir, out_filename, model, optimizer, scheduler, train_dict)
+    write_train_state(buffers)
+
+    return get_train_filenames(out_dir, out_filename)["model"]
+
+
+def dump_train_state(out_dir, out_filename, model, optimizer=None, scheduler=None, train_dict=None):
+    """
+    serialize a model and optionaly it's training info into in-memory buffers
+
+    The state dicts are snapshotted synchronously so the training can go on
+    modifying the weights while the buffers are written to disk
+    (see :func:`write_train_state`), for example from a background thread.
+
+    Parameters
+    ----------
+    out_dir : str
+        Path of directory where models files will be saved.
+    out_filename : str
+        name of the basename for the model file from which the other basename
+        will be derived
+    model : nn.Module
+        odeon/pytorch model to save
+    optimizer : nn.Module
+        optimizer used for training, by default None
+    scheduler : nn.Module
+        scheduler used for training, by default None
+    train_dict : dict
+        optional training info to save in train_*.pth file.
+
+    Returns
+    -------
+    :dict:
+        dictionnary with the destination path as key and the serialized
+        state as value (:class:`io.BytesIO`)
+    """
     train_filenames = get_train_filenames(out_dir, out_filename)
+    buffers = dict()
 
-    torch.save(model.state_dict(), train_filenames["model"])
+    def dump(obj, path):
+        buffer = io.BytesIO()
+        torch.save(obj, buffer)
+        buffers[path] = buffer
+
+    dump(model.state_dict(), train_filenames["model"])
 
     if optimizer is not None:
-        torch.save(optimizer.state_dict(), train_filenames["optimizer"])
+        dump(optimizer.state_dict(), train_filenames["optimizer"])
 
     if train_dict is not None or scheduler is not None:
         save_train_dict = train_dict if train_dict is not None else dict()
         if scheduler is not None:
             save_train_dict["scheduler"] = scheduler.state_dict()
 
-        torch.save(save_train_dict, train_filenames["train"])
+        dump(save_train_dict, train_filenames["train"])
+
+    return buffers
+
+
+def write_train_state(buffers):
+    """
+    write the buffers produced by :func:`dump_train_state` to disk
+
+    Each buffer goes to its own file (model, optimizer, train), so the files
+    are written in parallel.
+
+    Parameters
+    ----------
+    buffers : dict
+        dictionnary with the destination path as key and the serialized
+        state as value (:class:`io.BytesIO`)
+    """
+    def write(item):
+        path, buffer = item
+        with open(path, "wb") as file:
+            file.write(buffer.getbuffer())
 
-    return train_filenames["model"]
+    thread_map(write, buffers.items())
 
 
 def resume_train_state(out_dir, out_filename, optimizer=None, scheduler=None):
@@ -215,7 +363,7 @@ def resume_train_state(out_dir, out_filename, optimizer=None, scheduler=None):
     """
     train_filenames = get_train_filenames(out_dir, out_filename)
     if optimizer is not None:
-        optimizer.load_state_dict(torch.load(train_filenames["optimizer"]))
+        optimizer.load_state_dict(load_state(train_filenames["optimizer"]))
     if scheduler is not None and Path(train_filenames["train"]).exists():
-        train_dict = torch.load(train_filenames["train"])
+        train_dict = load_state(train_filenames["train"])
         scheduler.load_state_dict(train_dict["scheduler"])
@@ -1,19 +1,38 @@
+import os
 from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 
 from odeon.nn.history import History
 from odeon.commons.metrics import AverageMeter, get_confusion_matrix_torch, get_iou_metrics_torch
-from odeon.nn.models import save_model, get_train_filenames
+from odeon.nn.models import dump_train_state, write_train_state, get_train_filenames
 
 from odeon import LOGGER
 from odeon.commons.exception import OdeonError, ErrorCodes
 
+# torch.autocast(device_type=...) is available from pytorch 1.10
+AMP_AVAILABLE = hasattr(torch, "autocast") and hasattr(torch.cuda, "amp")
+# metrics are computed on raw logits: softmax does not change the argmax and
+# sigmoid(x) > 0.5 is x > 0
+LOGIT_THRESHOLD = 0.0
+# the running loss is copied to host for display every LOSS_DISPLAY_STEPS steps only
+LOSS_DISPLAY_STEPS = 50
+
 
 class TrainingEngine:
     """Training class
 
+    **Checkpoints :**
+    Model and training states are serialized in memory on the training thread and
+    written to disk by a background thread, so the training loop is not blocked
+    by disk I/O. A new checkpoint waits for the previous write to be completed and
+    the last one is flushed at the end of :meth:`run`.
+
     **Continue training :**
     Model and training metadata are saved on files with *LAST* prefix if training is
     stopped because of early_stopping (patience) or number of epochs conditions.
@@ -21,10 +40,25 @@ class TrainingEngine:
     training information are saved into  files with *INTERUPTED* prefix.
     Training is recover from the last modified models files.
 
+    **Distributed training :**
+    When a process group is initialized the model is expected to be wrapped in
+    :class:`DistributedDataParallel`. Validation loss and confusion matrix are
+    reduced over all the processes so they all take the same decisions, and only
+    the process of rank 0 writes checkpoints and history. A distributed sampler pads
+    the validation dataset with repeated patches so each process has the same number
+    of batches, validation metrics are approximate when the number of patches is not
+    a multiple of the number of processes.
+
+    **Mixed precision :**
+    On CUDA devices, with pytorch >= 1.10, forward pass and loss are computed under float16 autocast so
+    convolutions run on tensor cores, and gradients are scaled by a
+    :class:`GradScaler` to avoid underflow. It has no effect on CPU.
+
     Parameters
     ----------
     model : :class:`nn.Module`
-        pytorch model
+        pytorch model, optionally wrapped in :class:`DistributedDataParallel` and/or compiled
+        with ``torch.compile``
     loss : :class:`nn.Module`
         loss class
     optimizer : :class:`Optimizer`
@@ -51,6 +85,11 @@ class TrainingEngine:
         activate training reproducibility, by default False
     verbose : bool, optional
         verbosity, by default False
+    mixed_precision : bool, optional
+        activate automatic mixed precision on CUDA devices, by default True
+    channels_last : bool, optional
+        copy the images in channels last memory format, to be used with a model converted to
+        this format, by default False
 
     Raises
     ------
@@ -60,10 +99,17 @@ class TrainingEngine:
 
     def __init__(self, model, loss, optimizer, lr_scheduler, output_folder, output_filename,
                  epochs=300, batch_size=16, patience=20, save_history=False, continue_training=False,
-                 device=None, reproducible=False, verbose=False):
+                 device=None, reproducible=False, verbose=False, mixed_precision=True, channels_last=False):
 
         self.device = device if device is not None else ('cuda' if torch.cuda.is_available() else 'cpu')
         self.net = model.cuda(self.device) if self.device.startswith('cuda') else model
+        # unwrapped model, to access its attributes and save its weights without the compile and DDP prefixes
+        self.model = getattr(self.net, "_orig_mod", self.net)
+        if isinstance(self.model, DistributedDataParallel):
+            self.model = self.model.module
+        self.n_classes = self.model.n_classes
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.is_main_process = not self.distributed or dist.get_rank() == 0
         self.epochs = epochs
         self.batch_size = batch_size
         self.patience = patience
@@ -77,6 +123,22 @@ class TrainingEngine:
         self.train_iou = verbose
         self.multilabel = False
         self.micro_iou = True
+        self._checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_save = None
+        self.use_amp = mixed_precision and AMP_AVAILABLE and self.device.startswith('cuda')
+        self.scaler = torch.cuda.amp.GradScaler() if self.use_amp else None
+        if self.use_amp and hasattr(torch, "set_float32_matmul_precision"):
+            # matmuls left in float32 (outside of autocast) may use TF32 tensor cores on Ampere and newer GPUs
+            torch.set_float32_matmul_precision("high")
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        # patches have a constant size, cuDNN benchmarks its algorithms once and
+        # keeps the fastest one, which may not be deterministic
+        torch.backends.cudnn.benchmark = not reproducible
+        if reproducible:
+            # set once for the whole training, never toggled in the training loop
+            os.environ.setdefault("CUBLAS_WORKSPACE_CONFIG", ":4096:8")
+            torch.backends.cudnn.deterministic = True
+            torch.use_deterministic_algorithms(True, warn_only=True)
 
         # history
         train_files_dict = get_train_filenames(self.output_folder, self.output_filename)
@@ -113,155 +175,223 @@ class TrainingEngine:
                 patience_counter = len(all_val_loss) - all_val_loss.index(prec_val_loss) - 1
 
         # training loop
-        for epoch in range(epoch_start, self.epochs):
-            self.epoch_counter = epoch
-            # switch to train mode
-            self.net.train()
+        try:
+            for epoch in range(epoch_start, self.epochs):
+                self.epoch_counter = epoch
+                # reshuffle the shards of the distributed samplers
+                for loader in (train_loader, val_loader):
+                    if hasattr(loader.sampler, "set_epoch"):
+                        loader.sampler.set_epoch(epoch)
 
-            # run a pass on current epoch
-            train_loss, train_miou, avg_time = self._train_epoch(train_loader)
+                # switch to train mode
+                self.net.train()
 
-            # switch to evaluate mode
-            self.net.eval()
-            # run the validation pass
-            with torch.no_grad():
-                val_loss, val_miou = self._validate_epoch(val_loader)
+                # run a pass on current epoch
+                train_loss, train_miou, avg_time = self._train_epoch(train_loader)
 
-            self.lr_scheduler.step(val_loss)
+                # switch to evaluate mode
+                self.net.eval()
+                # run the validation pass
+                with torch.no_grad():
+                    val_loss, val_miou = self._validate_epoch(val_loader)
 
-            LOGGER.info(f"train_loss = {train_loss:03f}, val_loss = {val_loss:03f}")
-            if self.train_iou:
-                LOGGER.info(f"train_miou = {train_miou:03f}, val_miou = {val_miou:03f}")
-            else:
-                LOGGER.info(f"val_miou = {val_miou:03f}")
-
-            # update history
-            self.history.update(epoch, avg_time, train_loss, val_loss,
-                                self.optimizer.param_groups[0]['lr'], val_miou, train_mean_iou=train_miou)
-
-            # save model if val_loss has decreased
-            if prec_val_loss > val_loss:
-                model_filepath = save_model(
-                    self.output_folder, self.output_filename, self.net, optimizer=self.optimizer,
-                    scheduler=self.lr_scheduler)
-                LOGGER.info(f"Saving {model_filepath}")
-
-                if self.save_history:
-                    self.history.save()
-                    self.history.plot()
-
-                prec_val_loss = val_loss
-                patience_counter = 0
-            else:
-                patience_counter += 1
-
-            # stop training if patience is reached
-            if patience_counter == self.patience:
-                LOGGER.info(f"Model has not improved since {self.patience} epochs, train stopped.")
-                break
+                self.lr_scheduler.step(val_loss)
+
+                LOGGER.info(f"train_loss = {train_loss:03f}, val_loss = {val_loss:03f}")
+                if self.train_iou:
+                    LOGGER.info(f"train_miou = {train_miou:03f}, val_miou = {val_miou:03f}")
+                else:
+                    LOGGER.info(f"val_miou = {val_miou:03f}")
+
+                # update history
+                self.history.update(epoch, avg_time, train_loss, val_loss,
+                                    self.optimizer.param_groups[0]['lr'], val_miou, train_mean_iou=train_miou)
+
+                # save model if val_loss has decreased
+                if prec_val_loss > val_loss:
+                    if self.is_main_process:
+                        model_filepath = self.save_checkpoint()
+                        LOGGER.info(f"Saving {model_filepath}")
+
+                        if self.save_history:
+                            self.history.save()
+                            self.history.plot()
+
+                    prec_val_loss = val_loss
+                    patience_counter = 0
+                else:
+                    patience_counter += 1
+
+                # stop training if patience is reached
+                if patience_counter == self.patience:
+                    LOGGER.info(f"Model has not improved since {self.patience} epochs, train stopped.")
+                    break
+
+        finally:
+            self.wait_checkpoint()
+
+    def save_checkpoint(self):
+        """Snapshot the model, optimizer and scheduler states and write them
+        asynchronously in the output folder
+
+        Returns
+        -------
+        str
+            path to the saved model
+        """
+        buffers = dump_train_state(
+            self.output_folder, self.output_filename, self.model, optimizer=self.optimizer,
+            scheduler=self.lr_scheduler)
+        self.wait_checkpoint()
+        self._pending_save = self._checkpoint_executor.submit(write_train_state, buffers)
+        return get_train_filenames(self.output_folder, self.output_filename)["model"]
+
+    def wait_checkpoint(self):
+        """Block until the pending checkpoint, if any, is written on disk"""
+        if self._pending_save is not None:
+            pending_save, self._pending_save = self._pending_save, None
+            pending_save.result()
+
+    def to_device_image(self, images):
+        """Copy a batch of images to the training device, uint8 images are
+        normalized to [0, 1] there, in a single pass on the whole batch
+
+        Parameters
+        ----------
+        images : torch.Tensor
+
+        Returns
+        -------
+        torch.Tensor
+            float images on the training device
+        """
+        images = images.to(self.device, non_blocking=True, memory_format=self.memory_format)
+        if images.dtype == torch.uint8:
+            images = images.float().div_(255)
+        return images
+
+    def autocast(self):
+        """Context of the forward pass and loss: float16 autocast with mixed precision,
+        else an empty context"""
+        if self.use_amp:
+            return torch.autocast(device_type='cuda', dtype=torch.float16)
+        return nullcontext()
 
     def _train_epoch(self, loader):
 
         losses = AverageMeter("train_loss")
         use_cuda = True if self.device.startswith('cuda') else False
-        if self.multilabel or self.net.n_classes == 1:
-            confusion_matrix = torch.zeros((self.net.n_classes, 2, 2), dtype=torch.long)
+        if self.multilabel or self.n_classes == 1:
+            confusion_matrix = torch.zeros((self.n_classes, 2, 2), dtype=torch.long)
         else:
-            confusion_matrix = torch.zeros((self.net.n_classes, self.net.n_classes), dtype=torch.long)
+            confusion_matrix = torch.zeros((self.n_classes, self.n_classes), dtype=torch.long)
         if use_cuda:
-            confusion_matrix = confusion_matrix.cuda()
+            confusion_matrix = confusion_matrix.cuda(self.device)
 
         with tqdm(total=len(loader),
                   desc=f"Epochs {self.epoch_counter + 1}/{self.epochs}",
                   bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}{postfix}]') as pbar:
 
-            for sample in loader:
+            for step, sample in enumerate(loader):
 
-                images = sample['image'].cuda(self.device) if self.device.startswith('cuda') else sample['image']
-                masks = sample['mask'].cuda(self.device) if self.device.startswith('cuda') else sample['mask']
+                images = self.to_device_image(sample['image'])
+                masks = sample['mask'].to(self.device, non_blocking=True)
 
-                # clear gradient
-                self.optimizer.zero_grad()
+                # clear gradient, gradients are released instead of filled with zeros
+                self.optimizer.zero_grad(set_to_none=True)
 
-                # forward pass
-                logits = self.net(images)
+                with self.autocast():
+                    # forward pass
+                    logits = self.net(images)
 
-                # predictions
-                if self.net.n_classes == 1:
-                    preds = torch.sigmoid(logits)
-                else:
-                    preds = torch.softmax(logits, dim=1)
+                    # compute loss
+                    loss = self.loss(logits, masks)
+                    # loss = self.loss(logits, masks.long())
 
-                # compute loss
-                loss = self.loss(logits, masks)
-                # loss = self.loss(logits, masks.long())
+                if self.scaler is not None:
+                    # backward pass (calculate gradient), on the scaled loss with mixed precision
+                    self.scaler.scale(loss).backward()
 
-                # backward pass (calculate gradient)
-                loss.backward()
+                    # optimizer
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                else:
+                    # backward pass (calculate gradient)
+                    loss.backward()
 
-                # optimizer
-                self.optimizer.step()
+                    # optimizer
+                    self.optimizer.step()
 
                 # update statistics
-                #    loss
-                losses.update(loss.item(), self.batch_size)
+                #    loss, accumulated on device, the device is not synchronized on each step
+                losses.update(loss.detach(), self.batch_size)
+                if step % LOSS_DISPLAY_STEPS == 0:
+                    pbar_odict = OrderedDict(loss=f'{float(losses.avg):1.5f}')
+                    pbar.set_postfix(pbar_odict)
 
                 #    metrics
-                pbar_odict = OrderedDict(loss=f'{loss.item():1.5f}')
-                miou = None
                 if self.train_iou:
+                    # the confusion matrix is accumulated on device, out of the autograd graph,
+                    # and copied to host once at the end of epoch to compute the IoU
                     with torch.no_grad():
-                        confusion_matrix = confusion_matrix + get_confusion_matrix_torch(
-                            preds, masks, multilabel=self.multilabel, cuda=use_cuda)
-                        miou = get_iou_metrics_torch(confusion_matrix, micro=self.micro_iou, cuda=use_cuda)
-                    pbar_odict.update({'mean_iou': f'{miou:1.5f}'})
+                        confusion_matrix += get_confusion_matrix_torch(
+                            logits, masks, multilabel=self.multilabel, cuda=use_cuda, threshold=LOGIT_THRESHOLD)
 
-                pbar.set_postfix(pbar_odict)
                 pbar.update(1)
 
-        return losses.avg, miou, pbar.last_print_t - pbar.start_t
+            train_loss = float(losses.avg)
+            pbar_odict = OrderedDict(loss=f'{train_loss:1.5f}')
+            miou = None
+            if self.train_iou:
+                miou = get_iou_metrics_torch(confusion_matrix, micro=self.micro_iou, cuda=use_cuda)
+                pbar_odict.update({'mean_iou': f'{miou:1.5f}'})
+            pbar.set_postfix(pbar_odict)
+
+        return train_loss, miou, pbar.last_print_t - pbar.start_t
 
     def _validate_epoch(self, loader):
 
         losses = AverageMeter("val_loss")
         # confusion_matrix_np = np.zeros((2, 2), dtype=np.uint64)
         use_cuda = True if self.device.startswith('cuda') else False
-        if self.multilabel or self.net.n_classes == 1:
-            confusion_matrix = torch.zeros((self.net.n_classes, 2, 2), dtype=torch.long)
+        if self.multilabel or self.n_classes == 1:
+            confusion_matrix = torch.zeros((self.n_classes, 2, 2), dtype=torch.long)
         else:
-            confusion_matrix = torch.zeros((self.net.n_classes, self.net.n_classes), dtype=torch.long)
+            confusion_matrix = torch.zeros((self.n_classes, self.n_classes), dtype=torch.long)
         if use_cuda:
-            confusion_matrix = confusion_matrix.cuda()
+            confusion_matrix = confusion_matrix.cuda(self.device)
 
         with tqdm(total=len(loader), desc="Validating", leave=False) as pbar:
 
             for sample in loader:
 
-                images = sample['image'].cuda(self.device) if self.device.startswith('cuda') else sample['image']
-                masks = sample['mask'].cuda(self.device) if self.device.startswith('cuda') else sample['mask']
+                images = self.to_device_image(sample['image'])
+                masks = sample['mask'].to(self.device, non_blocking=True)
 
-                # forward pass
-                logits = self.net(images)
+                with self.autocast():
+                    # forward pass
+                    logits = self.net(images)
 
-                # predictions
-                if self.net.n_classes == 1:
-                    preds = torch.sigmoid(logits)
-                else:
-                    preds = torch.softmax(logits, dim=1)
-
-                # compute loss
-                loss = self.loss(logits, masks)
+                    # compute loss
+                    loss = self.loss(logits, masks)
 
                 # update statistics
-                #    loss
-                losses.update(loss.item(), self.batch_size)
+                #    loss, accumulated on device and copied to host once at the end of epoch
+                losses.update(loss.detach(), self.batch_size)
 
                 #    IOU
-                confusion_matrix = confusion_matrix + get_confusion_matrix_torch(
-                    preds, masks, multilabel=self.multilabel, cuda=use_cuda)
+                confusion_matrix += get_confusion_matrix_torch(
+                    logits, masks, multilabel=self.multilabel, cuda=use_cuda, threshold=LOGIT_THRESHOLD)
 
                 pbar.update(1)
 
+        val_loss = torch.as_tensor(losses.avg, dtype=torch.float, device=confusion_matrix.device)
+        if self.distributed:
+            # every process sees a shard of the validation set
+            dist.all_reduce(confusion_matrix)
+            dist.all_reduce(val_loss)
+            val_loss = val_loss / dist.get_world_size()
+
         # miou_np = get_iou_metrics(confusion_matrix_np)
         miou = get_iou_metrics_torch(confusion_matrix, micro=self.micro_iou, cuda=use_cuda)
-        return losses.avg, miou
+        return float(val_loss), miou
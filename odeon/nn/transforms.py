@@ -77,18 +77,21 @@ class Radiometry(object):
 
 
 class ToDoubleTensor(object):
-    """Convert ndarrays of sample(image, mask) into Tensors"""
+    """Convert ndarrays of sample(image, mask) into Tensors
+    uint8 images are kept in uint8, they are normalized on device by the training engine"""
 
     def __call__(self, **sample):
         image, mask = sample['image'], sample['mask']
         # swap color axis because
         # numpy image: H x W x C
         # torch image: C X H X W
-        image = image.transpose((2, 0, 1)).copy()
-        mask = mask.transpose((2, 0, 1)).copy()
+        # the transposition and the cast are done in a single copy, shared by torch.from_numpy
+        image = np.ascontiguousarray(image.transpose((2, 0, 1)),
+                                     dtype=np.uint8 if image.dtype == np.uint8 else np.float32)
+        mask = np.ascontiguousarray(mask.transpose((2, 0, 1)), dtype=np.float32)
         return {
-            'image': torch.as_tensor(image, dtype=torch.float),
-            'mask': torch.as_tensor(mask, dtype=torch.float)
+            'image': torch.from_numpy(image),
+            'mask': torch.from_numpy(mask)
         }
 
 
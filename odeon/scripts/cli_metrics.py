@@ -98,10 +98,10 @@ class CLIMetrics(BaseTool):
         self.mask_path = mask_path
         self.pred_path = pred_path
 
-        if os.path.exists(output_path) and os.path.isdir(output_path):
+        if os.path.isdir(output_path):
             name_output_path = os.path.join(output_path,
                                             'metrics_report_' + datetime.today().strftime("%Y_%m_%d_%H_%M_%S"))
-            os.makedirs(name_output_path)
+            os.makedirs(name_output_path, exist_ok=True)
             self.output_path = name_output_path
         else:
             raise OdeonError(ErrorCodes.ERR_DIR_NOT_EXIST,
@@ -7,6 +7,7 @@ main entry point to generation tool
 
 import os
 import glob
+import math
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
@@ -17,13 +18,12 @@ from rasterio.features import rasterize, geometry_window
 from shapely.geometry import shape
 from shapely.ops import transform as shape_transform
 from odeon.commons.image import CollectionDatasetReader
-from odeon.commons.rasterio import get_max_type
+from odeon.commons.rasterio import get_max_type, InMemoryRaster
 from odeon import LOGGER
 from odeon.commons.dataframe import set_path_to_center, split_dataset_from_df
 from odeon.commons.folder_manager import build_directories
 from odeon.commons.logger.logger import get_new_logger, get_simple_handler
-from odeon.commons.guard import geo_projection_raster_guard, geo_projection_vector_guard
-from odeon.commons.guard import vector_driver_guard, files_exist, dirs_exist, raster_bands_exist
+from odeon.commons.guard import validate_rasters, validate_vectors, files_exist, dirs_exist
 from odeon.commons.exception import OdeonError, ErrorCodes
 from odeon.commons.core import BaseTool
 
@@ -31,6 +31,12 @@ from odeon.commons.core import BaseTool
 STD_OUT_LOGGER = get_new_logger("stdout_generation")
 ch = get_simple_handler()
 STD_OUT_LOGGER.addHandler(ch)
+" GDAL block cache (in MB) shared by the rasters read during generation "
+GDAL_CACHEMAX = 512
+" rasterized masks up to this size (in bytes) are read once in memory "
+MAX_MASK_IN_MEMORY = 2**30
+" maximum number of pixels of the window over which a batch of polygons is rasterized "
+MAX_RASTERIZE_PIXELS = 2**24
 
 
 class Generator(BaseTool):
@@ -120,10 +126,14 @@ class Generator(BaseTool):
             self.set_number_of_image_band()
             self.set_meta_img_msk()
 
-            for i in range(self.num_seq):
-                self.clean()
-                self.pre_rasterize_mask(i)
-                self.generate(i)
+            # a block cache large enough to hold the blocks shared by
+            # neighbouring patches of all the layers and of the mask
+            with rasterio.Env(GDAL_CACHEMAX=GDAL_CACHEMAX):
+
+                for i in range(self.num_seq):
+                    self.clean()
+                    self.pre_rasterize_mask(i)
+                    self.generate(i)
 
         except Exception as error:
 
@@ -165,9 +175,8 @@ class Generator(BaseTool):
             try:
 
                 files_exist([raster["path"]])
-                geo_projection_raster_guard(raster["path"])
-                # raster_driver_guard(raster["path"])
-                raster_bands_exist(raster["path"], raster["bands"])
+                # driver is not checked (accepted_drivers=RASTER_DRIVER_ACCEPTED to do it)
+                validate_rasters(raster["path"], required_bands=raster["bands"])
 
             except OdeonError as oe:
 
@@ -180,8 +189,7 @@ class Generator(BaseTool):
             try:
 
                 files_exist([vector])
-                geo_projection_vector_guard(vector)
-                vector_driver_guard(vector)
+                validate_vectors(vector)
 
             except OdeonError as oe:
 
@@ -307,7 +315,7 @@ class Generator(BaseTool):
 
             self.nb_of_image_band += len(raster["bands"])
 
-        if ("DSM" and "DTM") in self.dict_of_raster and self.dem:
+        if "DSM" in self.dict_of_raster and "DTM" in self.dict_of_raster and self.dem:
 
             dsm_length = len(self.dict_of_raster["DSM"]["bands"])
             dtm_length = len(self.dict_of_raster["DTM"]["bands"])
@@ -589,78 +597,136 @@ class Generator(BaseTool):
 
                 with fiona.open(shape_file[pointer]) as polygons:
 
-                    for i, polygon in tqdm(enumerate(polygons), total=len(polygons)):
-
-                        try:
-
-                            geometry = polygon['geometry']
-                            geom = shape(geometry)
-                            if geom.has_z:
-                                geom_2d = shape_transform(lambda x, y, z: (x, y), geom)
-                            else:
-                                geom_2d = geom
-
-                            polygon_window = geometry_window(
-                                new_dataset,
-                                [geom_2d],
-                                pixel_precision=6).round_shape(op='ceil',
-                                                               pixel_precision=4)
-
-                            polygon_shape = (polygon_window.height, polygon_window.width)
-                            tuples = [geometry]
-                            polygon_transform = transform(polygon_window, new_dataset.transform)
-
-                            polygon_band = rasterize(tuples,
-                                                     out_shape=polygon_shape,
-                                                     default_value=1,
-                                                     transform=polygon_transform,
-                                                     dtype=rasterio.uint8,
-                                                     fill=0)
-
-                            old_band = new_dataset.read(idx, window=polygon_window)
-                            new_band = old_band.astype(np.bool) + polygon_band.astype(np.bool)
-                            new_band = new_band.astype(np.uint8)
-                            new_dataset.write_band(idx,
-                                                   new_band,
-                                                   window=polygon_window)
-
-                            # building the no label band
-                            """
-                            bands = new_dataset.read([1, len(self.shape_files)], window=polygon_window).astype(np.uint8)
-                            bands = bands.astype(np.bool).astype(np.uint8)
-                            other_band = np.sum(bands, axis=0, dtype=np.uint8)
-                            other_band = (other_band == 0).astype(np.uint8)
-                            new_dataset.write_band(len(self.shape_files) + 1, other_band, window=polygon_window)
-                            """
-
-                        except rasterio.errors.WindowError as error:
-
-                            LOGGER.warning(f"shape file: {shape_file}, polygon id: {i}")
-                            """this excepion occurs if a polygon it out of the raster bounds"""
-                            LOGGER.warning(f"window error during the rasterization"
-                                           f"of polygon {i} of classe {name} \n "
-                                           f"error: {error}")
-
-                        except MemoryError as error:
-
-                            LOGGER.warning(f"shape file: {shape_file}, polygon shape: , polygon id: {i}")
-                            """this excepion occurs if a polygon it out of the raster bounds"""
-                            LOGGER.warning(f"window error during the rasterization"
-                                           f"of polygon {i} of classe {name} \n "
-                                           f"error: {error}")
-                            """
-                            raise OdeonError(ErrorCodes.ERR_GENERATION_ERROR,
-                                             f"At least one of the polygon of shape file {shape_file} is too big",
-                                             error=error)
-                            """
-
-                        except ValueError as error:
-
-                            LOGGER.warning(f"shape file: {shape_file}, polygon id: {i}")
-                            """this excepion occurs if a polygon it out of the raster bounds"""
-                            LOGGER.warning(f"window error during the rasterization"
-                                           f"of polygon {i} of classe {name} \n "
-                                           f"error: {error}")
+                    self.burn_shapes(new_dataset, idx, tqdm(polygons, total=len(polygons)), name, shape_file)
+
+    @staticmethod
+    def burn_shapes(dataset, band_index, polygons, name, shape_file=None):
+        """Rasterize the polygons of a shape file in a band of the rasterized mask.
+        Polygons are burnt by batches, with one read / rasterize / write over the
+        union of their windows, as long as it stays below MAX_RASTERIZE_PIXELS
+
+        Parameters
+        ----------
+        dataset : rasterio.DatasetWriter
+         rasterized mask opened in w+ mode
+        band_index : int
+         index of the band of the class
+        polygons : iterable
+         fiona records (dict with a geometry) of the polygons
+        name : str
+         name of the class, for logging
+        shape_file : str, optional
+         path of the shape file, for logging
+
+        Returns
+        -------
+
+        """
+
+        batch_geometries, batch_window = [], None
+
+        for i, polygon in enumerate(polygons):
+
+            try:
+
+                geometry = polygon['geometry']
+                geom = shape(geometry)
+                if geom.has_z:
+                    geom_2d = shape_transform(lambda x, y, z: (x, y), geom)
+                else:
+                    geom_2d = geom
+
+                polygon_window = geometry_window(
+                    dataset,
+                    [geom_2d],
+                    pixel_precision=6).round_shape(op='ceil',
+                                                   pixel_precision=4)
+
+            except rasterio.errors.WindowError as error:
+
+                LOGGER.warning(f"shape file: {shape_file}, polygon id: {i}")
+                """this excepion occurs if a polygon it out of the raster bounds"""
+                LOGGER.warning(f"window error during the rasterization"
+                               f"of polygon {i} of classe {name} \n "
+                               f"error: {error}")
+                continue
+
+            except ValueError as error:
+
+                LOGGER.warning(f"shape file: {shape_file}, polygon id: {i}")
+                """this excepion occurs if a polygon it out of the raster bounds"""
+                LOGGER.warning(f"window error during the rasterization"
+                               f"of polygon {i} of classe {name} \n "
+                               f"error: {error}")
+                continue
+
+            union_window = polygon_window if batch_window is None else \
+                rasterio.windows.union(batch_window, polygon_window)
+
+            if batch_geometries and union_window.width * union_window.height > MAX_RASTERIZE_PIXELS:
+
+                Generator.burn_polygons(dataset, band_index, batch_geometries, batch_window, name)
+                batch_geometries, union_window = [], polygon_window
+
+            batch_geometries.append(geometry)
+            batch_window = union_window
+
+        if batch_geometries:
+
+            Generator.burn_polygons(dataset, band_index, batch_geometries, batch_window, name)
+
+    @staticmethod
+    def burn_polygons(dataset, band_index, geometries, window, name):
+        """Rasterize polygons in a band of the rasterized mask, they are burnt
+        in a single pass over the window and added to what the band already contains
+
+        Parameters
+        ----------
+        dataset : rasterio.DatasetWriter
+         rasterized mask opened in w+ mode
+        band_index : int
+         index of the band of the class
+        geometries : list[dict]
+         geometries of the polygons
+        window : rasterio.windows.Window
+         window covering all the polygons
+        name : str
+         name of the class, for logging
+
+        Returns
+        -------
+
+        """
+
+        # integer window enclosing the union of the polygon windows
+        col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+        window = rasterio.windows.Window(col_off,
+                                         row_off,
+                                         math.ceil(window.col_off + window.width) - col_off,
+                                         math.ceil(window.row_off + window.height) - row_off)
+
+        try:
+
+            polygon_band = rasterize(geometries,
+                                     out_shape=(window.height, window.width),
+                                     default_value=1,
+                                     transform=transform(window, dataset.transform),
+                                     dtype=rasterio.uint8,
+                                     fill=0)
+
+            old_band = dataset.read(band_index, window=window)
+            new_band = np.logical_or(old_band, polygon_band).astype(np.uint8)
+            dataset.write_band(band_index, new_band, window=window)
+
+        except MemoryError as error:
+
+            LOGGER.warning(f"{len(geometries)} polygons of classe {name} could not be rasterized "
+                           f"over window {window} \n error: {error}")
+
+        except ValueError as error:
+
+            LOGGER.warning(f"window error during the rasterization of {len(geometries)} polygons"
+                           f" of classe {name} over window {window} \n error: {error}")
 
     def generate(self, pointer):
         """
@@ -689,8 +755,9 @@ class Generator(BaseTool):
              rasterio metadata for mask generation
             meta_img : dict
              rasterio metadata for img generation
-            raster_out : str
-             path to write
+            raster_out : Union[rasterio.DatasetReader, InMemoryRaster]
+             rasterized full mask, opened once for all the centers, and read in memory
+             with :class:`InMemoryRaster` when it holds at most MAX_MASK_IN_MEMORY pixels
             dict_of_raster : dict
              a dictionary of raster name, raster file
             dem : bool
@@ -703,12 +770,24 @@ class Generator(BaseTool):
             None
 
             """
-            for _, center in tqdm(df.iterrows(), total=len(df)):
+            # centers are visited row of patches by row of patches, from west to east,
+            # so neighbouring patches are extracted one after the other while the
+            # blocks they share are still in GDAL's block cache.
+            patch_height = meta_img["height"] * meta_img["resolution"][1]
+            patch_rows = np.floor((meta_img["transform"].f - df["y"]) / patch_height)
+            df = df.assign(patch_row=patch_rows).sort_values(["patch_row", "x"], kind="stable")
+
+            # plain namedtuples avoid building a pandas Series for each row
+            centers = df[["x", "y", "img_file", "msk_file"]].itertuples(index=False, name="Center")
+
+            for center in tqdm(centers, total=len(df)):
 
                 try:
-                    # Verification if the future output file already exists. If True, the former one will be deleted.
-                    if os.path.isfile(center["img_file"]):
-                        os.remove(center["img_file"])
+                    # If the future output file already exists, the former one will be deleted.
+                    try:
+                        os.remove(center.img_file)
+                    except FileNotFoundError:
+                        pass
 
                     CollectionDatasetReader.stack_window_raster(center,
                                                                 dict_of_raster,
@@ -743,36 +822,54 @@ class Generator(BaseTool):
                 self.meta_msk['transform'] = self.dict_of_raster[source_type]['connection'].transform
                 self.meta_img['transform'] = self.meta_msk['transform']
 
-        for split_name, split in self.splits.items():
-            LOGGER.info(f"generating {split_name} data")
-            s = split[split["num_seq"] == pointer]
-
-            LOGGER.debug(s)
-            generate_data(s,
-                          self.meta_msk,
-                          self.meta_img,
-                          self.raster_out,
-                          self.dict_of_raster,
-                          self.dem,
-                          self.compute_only_masks)
-
-            output_split = os.path.join(self.output_path, f"{split_name}.csv")
-
-            if (self.append or pointer > 0) is True and os.path.isfile(output_split):
-                df = pd.read_csv(output_split, header=None, names=["img_file", "msk_file"])
-                df = pd.concat([df, s], ignore_index=True)
-                df = df.drop_duplicates(subset=['img_file', 'msk_file'], keep='last')
-                df[["img_file", "msk_file"]].to_csv(output_split,
-                                                    index=False,
-                                                    header=False)
+        # the full mask is opened once instead of once per patch, and if it is small enough,
+        # read once so the mask patches are sliced from memory. It is closed, like the source
+        # rasters, even if the generation fails
+        try:
 
-            else:
-                s[["img_file", "msk_file"]].to_csv(output_split,
-                                                   index=False,
-                                                   header=False)
-        # Close all opened rasters
-        for source_type in self.dict_of_raster.keys():
-            self.dict_of_raster[source_type]['connection'].close()
+            with rasterio.open(self.raster_out) as mask_connection:
+
+                if mask_connection.count * mask_connection.height * mask_connection.width <= MAX_MASK_IN_MEMORY:
+
+                    mask_reader = InMemoryRaster(mask_connection)
+
+                else:
+
+                    mask_reader = mask_connection
+
+                for split_name, split in self.splits.items():
+                    LOGGER.info(f"generating {split_name} data")
+                    s = split[split["num_seq"] == pointer]
+
+                    LOGGER.debug(s)
+                    generate_data(s,
+                                  self.meta_msk,
+                                  self.meta_img,
+                                  mask_reader,
+                                  self.dict_of_raster,
+                                  self.dem,
+                                  self.compute_only_masks)
+
+                    output_split = os.path.join(self.output_path, f"{split_name}.csv")
+
+                    if (self.append or pointer > 0) is True and os.path.isfile(output_split):
+                        df = pd.read_csv(output_split, header=None, names=["img_file", "msk_file"])
+                        df = pd.concat([df, s], ignore_index=True)
+                        df = df.drop_duplicates(subset=['img_file', 'msk_file'], keep='last')
+                        df[["img_file", "msk_file"]].to_csv(output_split,
+                                                            index=False,
+                                                            header=False)
+
+                    else:
+                        s[["img_file", "msk_file"]].to_csv(output_split,
+                                                           index=False,
+                                                           header=False)
+
+        finally:
+
+            # Close all opened rasters
+            for source_type in self.dict_of_raster.keys():
+                self.dict_of_raster[source_type]['connection'].close()
 
     def clean(self):
         """Clean temporary pre-rasterized mask
@@ -781,6 +878,10 @@ class Generator(BaseTool):
         -------
 
         """
-        if os.path.isfile(self.raster_out):
+        try:
 
             os.remove(self.raster_out)
+
+        except FileNotFoundError:
+
+            pass
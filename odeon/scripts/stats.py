@@ -100,7 +100,7 @@ class Stats(BaseTool):
         else:
             name_output_path = os.path.join(output_path,
                                             'stats_report_' + datetime.today().strftime("%Y_%m_%d_%H_%M_%S"))
-            os.makedirs(name_output_path)
+            os.makedirs(name_output_path, exist_ok=True)
             self.output_path = name_output_path
 
         if output_type in ['md', 'json', 'html', 'terminal']:
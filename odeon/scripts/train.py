@@ -22,14 +22,19 @@ Notes
 
 import os
 import os.path
-import csv
-import json
+import inspect
+import random
+import numpy as np
+import pandas as pd
 from sklearn.model_selection import train_test_split
 
 import torch
+import torch.distributed as dist
 from torch import optim
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 from odeon.commons.core import BaseTool
 from odeon.commons.exception import OdeonError, ErrorCodes
@@ -38,7 +43,8 @@ from odeon.commons.guard import files_exist, dirs_exist
 from odeon.nn.transforms import Compose, Rotation90, Rotation, Radiometry, ToDoubleTensor
 from odeon.nn.datasets import PatchDataset
 from odeon.nn.training_engine import TrainingEngine
-from odeon.nn.models import model_list, build_model, save_model, load_model, get_train_filenames, resume_train_state
+from odeon.nn.models import model_list, build_model, save_model, load_model, get_train_filenames, resume_train_state, \
+    enable_gradient_checkpointing
 from odeon.nn.losses import BCEWithLogitsLoss, CrossEntropyWithLogitsLoss, FocalLoss2d, ComboLoss
 
 " A logger for big message "
@@ -46,11 +52,46 @@ STD_OUT_LOGGER = get_new_logger("stdout_training")
 ch = get_simple_handler()
 STD_OUT_LOGGER.addHandler(ch)
 INTERRUPTED = "INTERRUPTED.pth"
+" optimizer classes and loss factories by configuration name "
+OPTIMIZERS = {
+    "adam": optim.Adam,
+    "SGD": optim.SGD
+}
+LOSSES = {
+    "ce": CrossEntropyWithLogitsLoss,
+    "bce": BCEWithLogitsLoss,
+    # scripted so its chain of element-wise operations runs as fused kernels
+    "focal": lambda: torch.jit.script(FocalLoss2d()),
+    "combo": lambda: ComboLoss({'bce': 0.75, 'jaccard': 0.25})
+}
+" more loader workers than this only add memory, the patches are small "
+MAX_LOADER_WORKERS = 8
+" persistent workers and prefetch factor exist from pytorch 1.7, static graph DDP from 1.11 "
+PERSISTENT_WORKERS_AVAILABLE = "persistent_workers" in inspect.signature(DataLoader.__init__).parameters
+STATIC_GRAPH_AVAILABLE = "static_graph" in inspect.signature(DistributedDataParallel.__init__).parameters
+
+
+def seed_worker(worker_id):
+    """Seed the python and numpy generators of a DataLoader worker (used by the
+    transforms) from its torch seed, itself derived from the DataLoader generator
+
+    Parameters
+    ----------
+    worker_id : int
+        id of the worker
+    """
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
 
 
 class Trainer(BaseTool):
     """Main entry point of training tool
 
+    When launched with torchrun (``WORLD_SIZE`` environment variable greater than 1),
+    one process is run per GPU: the model is wrapped in :class:`DistributedDataParallel`
+    and each process reads its own shard of the samples.
+
     Implements
     ----------
     BaseTool : object
@@ -79,7 +120,10 @@ class Trainer(BaseTool):
                  lr=0.001,
                  data_augmentation=None,
                  device=None,
-                 reproducible=False
+                 reproducible=False,
+                 gradient_checkpointing=False,
+                 mixed_precision=True,
+                 compile_model=False
                  ):
         """[summary]
 
@@ -129,13 +173,37 @@ class Trainer(BaseTool):
             device if None 'cpu' or 'cuda' if available will be used, by default None
         reproducible : bool, optional
             activate training reproducibility, by default False
+        gradient_checkpointing : bool, optional
+            recompute the encoder activations in the backward pass instead of keeping them,
+            to train with larger batches, by default False
+        mixed_precision : bool, optional
+            train with float16 automatic mixed precision on CUDA devices (pytorch >= 1.10),
+            by default True
+        compile_model : bool, optional
+            compile the model with torch.compile (pytorch >= 2.0), the model runs eagerly
+            if compilation is not available or fails, by default False
         """
         self.verbosity = verbosity
         self.model_name = model_name
         self.output_folder = output_folder
         self.reproducible = reproducible
+        self.gradient_checkpointing = gradient_checkpointing
+        self.mixed_precision = mixed_precision
+        self.compile_model = compile_model
         self.interrupted = INTERRUPTED
         self.last_name = 'LAST.pth'
+        self._train_files = None
+
+        # distributed data parallel, one process per GPU launched by torchrun
+        self.world_size = int(os.environ.get("WORLD_SIZE", 1))
+        self.local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        self.distributed = self.world_size > 1
+        if self.distributed:
+            if not dist.is_initialized():
+                dist.init_process_group("nccl")
+            torch.cuda.set_device(self.local_rank)
+            device = f"cuda:{self.local_rank}"
+        self.device = device if device is not None else ('cuda' if torch.cuda.is_available() else 'cpu')
 
         if reproducible is True:
             self.random_seed = 2020
@@ -176,6 +244,8 @@ class Trainer(BaseTool):
             value for key, value in transformation_dict.items() if key in transformation_keys
         ]
         self.transformation_functions.append(ToDoubleTensor())
+        # radiometry works on [0, 1] float images, otherwise uint8 images are normalized on GPU
+        normalize = "radiometry" in transformation_keys or not self.device.startswith('cuda')
 
         assert self.batch_size <= len(self.train_image_files), "batch_size must be lower than the length of training \
                                                                 dataset"
@@ -183,21 +253,52 @@ class Trainer(BaseTool):
                                      self.train_mask_files,
                                      transform=Compose(self.transformation_functions),
                                      image_bands=image_bands,
-                                     mask_bands=mask_bands)
+                                     mask_bands=mask_bands,
+                                     normalize=normalize)
+        # training workers are kept alive between epochs and batches are copied in pinned memory
+        # so the copy to GPU runs asynchronously
+        # shuffling and workers seeds come from a dedicated generator, seeded when the
+        # training is reproducible
+        generator = torch.Generator()
+        if self.random_seed is not None:
+            torch.manual_seed(self.random_seed)
+            generator.manual_seed(self.random_seed)
+        else:
+            generator.seed()
+        loader_options = dict(num_workers=min(MAX_LOADER_WORKERS,
+                                              max(1, (os.cpu_count() or 2) // (2 * self.world_size))),
+                              pin_memory=self.device.startswith('cuda'),
+                              generator=generator,
+                              worker_init_fn=seed_worker)
+        train_loader_options = dict(loader_options)
+        if PERSISTENT_WORKERS_AVAILABLE:
+            loader_options["prefetch_factor"] = 4
+            train_loader_options.update(persistent_workers=True, prefetch_factor=4)
+        sampler_seed = self.random_seed if self.random_seed is not None else 0
+        train_sampler = DistributedSampler(train_dataset, shuffle=True, seed=sampler_seed) \
+            if self.distributed else None
         self.train_dataloader = DataLoader(train_dataset,
                                            self.batch_size,
-                                           shuffle=True,
-                                           num_workers=8,
-                                           drop_last=True)
+                                           shuffle=train_sampler is None,
+                                           sampler=train_sampler,
+                                           drop_last=True,
+                                           **train_loader_options)
         val_dataset = PatchDataset(self.val_image_files,
                                    self.val_mask_files,
                                    transform=Compose(self.transformation_functions),
                                    image_bands=image_bands,
-                                   mask_bands=mask_bands)
+                                   mask_bands=mask_bands,
+                                   normalize=normalize)
+        # validation runs once per epoch, its workers are not kept alive next to the training ones.
+        # The distributed sampler pads the dataset with repeated patches so each process gets the
+        # same number of batches: validation metrics are approximate when the number of
+        # patches is not a multiple of the number of processes
+        val_sampler = DistributedSampler(val_dataset, shuffle=False) if self.distributed else None
         self.val_dataloader = DataLoader(val_dataset,
                                          self.batch_size,
-                                         shuffle=True,
-                                         num_workers=8)
+                                         shuffle=val_sampler is None,
+                                         sampler=val_sampler,
+                                         **loader_options)
 
         if image_bands is not None:
             self.n_channels = len(image_bands)
@@ -208,7 +309,11 @@ class Trainer(BaseTool):
         else:
             self.n_classes = self.get_sample_shape(train_dataset)['mask'][0]
 
-        self.device = device if device is not None else ('cuda' if torch.cuda.is_available() else 'cpu')
+        # the cross entropy only needs the class of each pixel, masks are sent as class
+        # indices instead of one channel by class
+        if self.loss_name == "ce" and self.n_classes > 1:
+            train_dataset.class_index_mask = True
+            val_dataset.class_index_mask = True
 
         STD_OUT_LOGGER.info(f"""training :
 device: {self.device}
@@ -258,7 +363,26 @@ val: {len(val_dataset)})""")
         if not continue_train:
             self.model = build_model(self.model_name, self.n_channels, self.n_classes)
         else:
-            self.model = load_model(self.model_name, train_files["model"], self.n_channels, self.n_classes)
+            # loaded on the training device, so the optimizer state is restored there too
+            self.model = load_model(self.model_name, train_files["model"], self.n_channels, self.n_classes,
+                                    device=self.device)
+
+        if self.gradient_checkpointing:
+            enable_gradient_checkpointing(self.model)
+
+        channels_last = self.device.startswith("cuda")
+        if channels_last:
+            # NHWC layout matches the tensor core convolution kernels, converted before DDP
+            # and compile so they see the final parameters
+            self.model = self.model.to(self.device, memory_format=torch.channels_last)
+
+        net = self.model
+        if self.distributed:
+            ddp_options = dict(static_graph=True) if STATIC_GRAPH_AVAILABLE else {}
+            net = DistributedDataParallel(self.model.cuda(self.device), device_ids=[self.local_rank],
+                                          gradient_as_bucket_view=True, **ddp_options)
+        if self.compile_model:
+            net = self.compile(net)
 
         self.optimizer_function = self.get_optimizer(self.optimizer_name, self.model, self.init_lr)
         lr_scheduler = ReduceLROnPlateau(
@@ -276,7 +400,7 @@ val: {len(val_dataset)})""")
 
         loss_function = self.get_loss(self.loss_name, class_weight=self.class_imbalance)
 
-        self.trainer = TrainingEngine(self.model,
+        self.trainer = TrainingEngine(net,
                                       loss_function,
                                       self.optimizer_function,
                                       lr_scheduler,
@@ -289,13 +413,14 @@ val: {len(val_dataset)})""")
                                       continue_training=continue_train,
                                       reproducible=self.reproducible,
                                       device=self.device,
-                                      verbose=self.verbosity)
+                                      verbose=self.verbosity,
+                                      mixed_precision=self.mixed_precision,
+                                      channels_last=channels_last)
 
         net_params = sum(p.numel() for p in self.model.parameters())
 
         if continue_train:
-            with open(train_files["history"], 'r') as file:
-                self.trainer.history.history_dict = json.load(file)
+            self.trainer.history.load(train_files["history"])
 
         STD_OUT_LOGGER.info(f"Model parameters trainable : {net_params}")
 
@@ -306,9 +431,9 @@ val: {len(val_dataset)})""")
         try:
             self.trainer.run(self.train_dataloader, self.val_dataloader)
             # if continue training and stopped cause by patience save 'LAST' model
-            if self.continue_training:
+            if self.continue_training and self.trainer.is_main_process:
                 model_filepath = save_model(
-                    self.output_folder, f'{self.last_name}', self.trainer.net, optimizer=self.trainer.optimizer,
+                    self.output_folder, f'{self.last_name}', self.trainer.model, optimizer=self.trainer.optimizer,
                     scheduler=self.trainer.lr_scheduler)
                 STD_OUT_LOGGER.info(f"Save '{self.last_name}' model : {model_filepath}")
                 last_filenames = get_train_filenames(self.output_folder, f'{self.last_name}')
@@ -320,6 +445,8 @@ val: {len(val_dataset)})""")
             raise error
 
         except KeyboardInterrupt:
+            if not self.trainer.is_main_process:
+                return
             tmp_file = save_model(
                 self.output_folder, f'{self.interrupted}', model=self.model, optimizer=self.optimizer_function,
                 scheduler=self.trainer.lr_scheduler)
@@ -330,6 +457,40 @@ val: {len(val_dataset)})""")
                 history = self.trainer.history
                 history.save(out_file=train_files["history"])
 
+        finally:
+            if self.distributed:
+                dist.destroy_process_group()
+
+    def compile(self, net):
+        """Compile a model with torch.compile, which fuses convolutions, batch norms
+        and activations.
+        The model is returned as is if torch.compile is not available, and graphs
+        which fail to compile (e.g. on GPU not supported by triton) run eagerly.
+
+        Parameters
+        ----------
+        net : nn.Module
+            pytorch neural network object
+
+        Returns
+        -------
+        nn.Module
+            the compiled model, or net
+        """
+
+        if not hasattr(torch, "compile"):
+            STD_OUT_LOGGER.warning("torch.compile needs pytorch >= 2.0, the model is not compiled")
+            return net
+
+        try:
+            from torch import _dynamo
+            _dynamo.config.suppress_errors = True
+            return torch.compile(net)
+
+        except Exception as error:
+            STD_OUT_LOGGER.warning(f"the model could not be compiled, it runs eagerly: {error}")
+            return net
+
     def read_csv_sample_file(self, file_path):
         """Read a sample CSV file and return a list of image files and a list of mask files.
         CSV file should contain image pathes in the first column and mask pathes in the second.
@@ -344,19 +505,23 @@ val: {len(val_dataset)})""")
         Tuple[list, list]
             a list of image pathes and a list of mask pathes
         """
-        image_files = []
-        mask_files = []
         if not os.path.exists(file_path):
 
             raise OdeonError(ErrorCodes.ERR_FILE_NOT_EXIST,
                              f"file ${file_path} does not exist.")
 
-        with open(file_path) as csvfile:
-            sample_reader = csv.reader(csvfile)
-            for item in sample_reader:
-                image_files.append(item[0])
-                mask_files.append(item[1])
-        return image_files, mask_files
+        # the columns are converted to lists at once, paths like "NA" or "null" are kept as is
+        try:
+            df = pd.read_csv(file_path, header=None, dtype=str, keep_default_na=False, na_filter=False)
+        except pd.errors.EmptyDataError:
+            return [], []
+
+        if df.shape[1] < 2:
+
+            raise OdeonError(ErrorCodes.ERR_FIELD_NOT_FOUND,
+                             f"file {file_path} should have an image column and a mask column.")
+
+        return df[0].tolist(), df[1].tolist()
 
     def get_optimizer(self, optimizer_name, model, lr):
         """Initialize optimizer object from name
@@ -373,10 +538,17 @@ val: {len(val_dataset)})""")
         -------
             torch.Optimizer
         """
-        if optimizer_name == 'adam':
-            return optim.Adam(model.parameters(), lr=lr)
-        elif optimizer_name == 'SGD':
-            return optim.SGD(model.parameters(), lr=lr)
+        optimizer_class = OPTIMIZERS.get(optimizer_name)
+        if optimizer_class is not None:
+            # update all the parameters in a single fused kernel on GPU, or at least with
+            # multi tensor kernels, when the installed pytorch supports it
+            options = dict(lr=lr)
+            optimizer_parameters = inspect.signature(optimizer_class).parameters
+            if "fused" in optimizer_parameters and next(model.parameters()).is_cuda:
+                options["fused"] = True
+            elif "foreach" in optimizer_parameters:
+                options["foreach"] = True
+            return optimizer_class(model.parameters(), **options)
 
     def get_loss(self, loss_name, class_weight=None, use_cuda=False):
         """Initialize loss class instance
@@ -397,24 +569,16 @@ val: {len(val_dataset)})""")
             [description]
         """
 
-        if loss_name == "ce":
-            if class_weight is not None:
-                STD_OUT_LOGGER.info(f"Weights used: {class_weight}")
-                weight = torch.FloatTensor(class_weight)
-                if use_cuda:
-                    weight = weight.cuda()
-                return CrossEntropyWithLogitsLoss(weight=weight)
-
-            else:
-
-                return CrossEntropyWithLogitsLoss()
+        if loss_name == "ce" and class_weight is not None:
+            STD_OUT_LOGGER.info(f"Weights used: {class_weight}")
+            weight = torch.FloatTensor(class_weight)
+            if use_cuda:
+                weight = weight.cuda()
+            return CrossEntropyWithLogitsLoss(weight=weight)
 
-        elif loss_name == "bce":
-            return BCEWithLogitsLoss()
-        elif loss_name == "focal":
-            return FocalLoss2d()
-        elif loss_name == "combo":
-            return ComboLoss({'bce': 0.75, 'jaccard': 0.25})
+        loss_factory = LOSSES.get(loss_name)
+        if loss_factory is not None:
+            return loss_factory()
 
     def get_sample_shape(self, dataset):
         """get sample shape from dataloader
@@ -435,30 +599,41 @@ val: {len(val_dataset)})""")
         return {'image': sample['image'].shape, 'mask': sample['mask'].shape}
 
     def get_train_filenames(self):
+        """Find the model files to resume from (the most recent of model, INTERRUPTED and LAST files)
+        The result is computed once and reused by check and configure.
 
-        train_files = get_train_filenames(self.output_folder, self.model_filename)
-        if self.continue_training:
-            if os.path.exists(train_files["model"]):
-                model_modif_date = os.path.getmtime(train_files["model"])
-            else:
-                model_modif_date = os.path.getmtime(self.output_folder)
+        Returns
+        -------
+        Tuple[dict, bool]
+            the training files dict and True if the training is continued from these files
+        """
 
-            interrupted_files = get_train_filenames(self.output_folder, self.interrupted)
-            if os.path.exists(interrupted_files["model"]):
-                interrupted_modif_date = os.path.getmtime(interrupted_files["model"])
-                if interrupted_modif_date > model_modif_date:
-                    train_files = interrupted_files
-                    model_modif_date = interrupted_modif_date
+        if self._train_files is not None:
+            return self._train_files
 
-            last_files = get_train_filenames(self.output_folder, self.last_name)
-            if os.path.exists(last_files["model"]):
-                last_modif_date = os.path.getmtime(last_files["model"])
-                if last_modif_date > model_modif_date:
-                    train_files = last_files
-                    model_modif_date = last_modif_date
+        def get_mtime(path):
+            # a single stat call, None if the file does not exist
+            try:
+                return os.stat(path).st_mtime
+            except OSError:
+                return None
 
+        train_files = get_train_filenames(self.output_folder, self.model_filename)
         continue_train = False
-        if self.continue_training and os.path.exists(train_files["model"]):
-            continue_train = True
 
-        return train_files, continue_train
+        if self.continue_training:
+            model_modif_date = get_mtime(train_files["model"])
+            continue_train = model_modif_date is not None
+            if model_modif_date is None:
+                model_modif_date = os.path.getmtime(self.output_folder)
+
+            for name in [self.interrupted, self.last_name]:
+                candidate_files = get_train_filenames(self.output_folder, name)
+                candidate_modif_date = get_mtime(candidate_files["model"])
+                if candidate_modif_date is not None and candidate_modif_date > model_modif_date:
+                    train_files = candidate_files
+                    model_modif_date = candidate_modif_date
+                    continue_train = True
+
+        self._train_files = (train_files, continue_train)
+        return self._train_files
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.features import rasterize
+from rasterio.transform import from_origin
+from shapely.geometry import box, mapping
+
+from odeon.scripts import generate
+from odeon.scripts.generate import Generator
+
+
+class TestBurnShapes(object):
+
+    @pytest.fixture
+    def mask_dataset(self, tmp_path):
+
+        meta = {"driver": "GTiff", "count": 2, "height": 64, "width": 64, "dtype": "uint8",
+                "crs": "EPSG:2154", "transform": from_origin(0, 64, 1, 1)}
+
+        with rasterio.open(str(tmp_path / "full_mask.tif"), "w+", **meta) as dataset:
+            yield dataset
+
+    @pytest.fixture
+    def polygons(self):
+
+        # overlapping boxes, boxes off the pixel grid and far apart boxes
+        boxes = [box(2, 2, 20, 20), box(10, 10, 30, 30), box(40.5, 3.2, 60.7, 12.9),
+                 box(5, 45, 12, 60), box(50, 50, 63, 63)]
+
+        return [{"geometry": mapping(geometry)} for geometry in boxes]
+
+    @pytest.mark.parametrize("max_pixels", [2**24, 400, 1])
+    def test_same_mask_as_single_rasterize(self, mask_dataset, polygons, monkeypatch, max_pixels):
+
+        monkeypatch.setattr(generate, "MAX_RASTERIZE_PIXELS", max_pixels)
+
+        Generator.burn_shapes(mask_dataset, 1, polygons, "building")
+
+        expected = rasterize([polygon["geometry"] for polygon in polygons],
+                             out_shape=(64, 64),
+                             default_value=1,
+                             transform=mask_dataset.transform,
+                             dtype=rasterio.uint8,
+                             fill=0)
+        np.testing.assert_array_equal(mask_dataset.read(1), expected)
+        np.testing.assert_array_equal(mask_dataset.read(2), 0)
+
+    def test_no_polygon(self, mask_dataset):
+
+        Generator.burn_shapes(mask_dataset, 1, [], "building")
+
+        np.testing.assert_array_equal(mask_dataset.read(1), 0)
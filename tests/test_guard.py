@@ -0,0 +1,81 @@
+import os
+import pytest
+
+from odeon.commons import guard
+from odeon.commons.exception import OdeonError
+from odeon.commons.guard import files_exist, dirs_exist, MIN_ENTRIES_TO_LIST
+
+
+class TestFilesExist(object):
+
+    @pytest.fixture
+    def sample_dir(self, tmp_path):
+
+        sample_dir = tmp_path / "samples"
+        sample_dir.mkdir()
+        for i in range(1, MIN_ENTRIES_TO_LIST + 1):
+            (sample_dir / f"img_{i}.tif").write_bytes(b"")
+        (sample_dir / "sub").mkdir()
+
+        yield sample_dir
+
+    @pytest.fixture
+    def unlistable(self, monkeypatch):
+
+        # a directory with --x permissions can be traversed but not listed, root
+        # ignores permissions so the listing error is simulated
+        def scandir(path):
+            raise PermissionError(13, "Permission denied", path)
+
+        monkeypatch.setattr(guard.os, "scandir", scandir)
+
+    def test_present_file(self, sample_dir):
+
+        files_exist([str(sample_dir / "img_1.tif")])
+
+    def test_missing_file(self, sample_dir):
+
+        with pytest.raises(OdeonError):
+            files_exist([str(sample_dir / "img_1.tif"), str(sample_dir / "img_0.tif")])
+
+    def test_listed_directory(self, sample_dir):
+
+        file_names = [str(sample_dir / f"img_{i}.tif") for i in range(1, MIN_ENTRIES_TO_LIST + 1)]
+
+        files_exist(file_names)
+
+        with pytest.raises(OdeonError):
+            files_exist(file_names + [str(sample_dir / "img_0.tif")])
+
+        with pytest.raises(OdeonError):
+            files_exist(file_names + [str(sample_dir / "sub")])
+
+    def test_directory_is_not_a_file(self, sample_dir):
+
+        with pytest.raises(OdeonError):
+            files_exist([str(sample_dir / "sub")])
+
+    def test_unlistable_directory(self, sample_dir, unlistable):
+
+        file_names = [str(sample_dir / f"img_{i}.tif") for i in range(1, MIN_ENTRIES_TO_LIST + 1)]
+
+        files_exist(file_names)
+        dirs_exist([str(sample_dir / "sub")])
+
+        with pytest.raises(OdeonError):
+            files_exist(file_names + [str(sample_dir / "img_0.tif")])
+
+        with pytest.raises(OdeonError):
+            dirs_exist([os.path.join(str(sample_dir), "missing")])
+
+
+class TestDirsExist(object):
+
+    def test_present_and_missing_dirs(self, tmp_path):
+
+        (tmp_path / "img").mkdir()
+
+        dirs_exist([str(tmp_path / "img"), str(tmp_path)])
+
+        with pytest.raises(OdeonError):
+            dirs_exist([str(tmp_path / "img"), str(tmp_path / "msk")])
@@ -0,0 +1,35 @@
+import numpy as np
+
+from odeon.commons.image import convert_to_dtype
+
+
+class TestConvertToDtype(object):
+
+    def test_same_dtype_unchanged(self):
+
+        img = np.arange(12, dtype=np.uint8).reshape(2, 2, 3)
+
+        assert convert_to_dtype(img, "uint8") is img
+
+    def test_float_rounded_and_clipped(self):
+
+        img = np.array([-0.5, 0.0, 0.1, 0.5, 0.999, 1.0, 1.5, np.float32(2 / 255)], dtype=np.float32)
+
+        result = convert_to_dtype(img, "uint8")
+
+        assert result.dtype == np.uint8
+        np.testing.assert_array_equal(result, [0, 0, 26, 128, 255, 255, 255, 2])
+
+    def test_uint8_to_uint16(self):
+
+        result = convert_to_dtype(np.array([0, 1, 128, 255], dtype=np.uint8), "uint16")
+
+        assert result.dtype == np.uint16
+        np.testing.assert_array_equal(result, [0, 257, 32896, 65535])
+
+    def test_uint16_to_uint8(self):
+
+        result = convert_to_dtype(np.array([0, 257, 32896, 65535, 200], dtype=np.uint16), "uint8")
+
+        assert result.dtype == np.uint8
+        np.testing.assert_array_equal(result, [0, 1, 128, 255, 1])
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from odeon.commons.kernels import compute_dem, compute_dem_numpy, compute_dem_numba
+
+
+class TestComputeDem(object):
+
+    @pytest.fixture
+    def elevations(self):
+
+        rng = np.random.RandomState(2020)
+        dsm = rng.uniform(0, 100, size=(64, 64)).astype(np.float32)
+        dtm = dsm - rng.uniform(-10, 80, size=(64, 64)).astype(np.float32)
+        dsm[0, :4] = np.nan
+
+        yield dsm, dtm
+
+    def test_clipped_scaled_height(self, elevations):
+
+        dsm, dtm = elevations
+        result = compute_dem(dsm, dtm, 5 / 255)
+
+        expected = np.clip((dsm - dtm) * np.float32(5 / 255), 0, 1)
+        assert result.dtype == np.float32
+        assert result.shape == dsm.shape
+        np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+    @pytest.mark.skipif(compute_dem_numba is None, reason="numba is not installed")
+    def test_numba_same_as_numpy(self, elevations):
+
+        dsm, dtm = elevations
+        numba_out = np.empty(dsm.size, dtype=np.float32)
+        numpy_out = np.empty(dsm.shape, dtype=np.float32)
+
+        compute_dem_numba(dsm.ravel(), dtm.ravel(), np.float32(5 / 255), numba_out)
+        compute_dem_numpy(dsm, dtm, 5 / 255, numpy_out)
+
+        np.testing.assert_array_equal(numba_out.reshape(dsm.shape), numpy_out)
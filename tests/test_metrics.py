@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+import torch
+
+from odeon.commons.metrics import binarizes, get_confusion_matrix, get_binary_confusion_matrix
+
+
+def loop_binarizes(detection, threshold=0.5, multilabel=False):
+    """binarizes as written with per class loops, the reference of the vectorized version"""
+    no_of_class = detection.shape[1]
+    if no_of_class == 1 or multilabel:
+        tmp = detection.copy()
+        tmp[detection > threshold] = 1
+        tmp[detection <= threshold] = 0
+        return tmp.copy()
+    labels = np.argmax(detection, axis=1)
+    v_other = no_of_class + 1
+    result = []
+    for c in np.nditer(np.arange(no_of_class)):
+        tmp = labels.copy()
+        tmp[tmp != c] = v_other
+        tmp[tmp == c] = 1
+        tmp[tmp == v_other] = 0
+        result.append(tmp.copy())
+    return np.array(result).swapaxes(0, 1)
+
+
+def loop_binary_confusion_matrix(prediction, target):
+    """get_binary_confusion_matrix with boolean indexing, the reference of the vectorized version"""
+    tp = np.sum(np.logical_and(target, prediction))
+    tn = np.sum(np.logical_not(np.logical_or(target, prediction)))
+    fp = np.sum(prediction[target == 0] == 1)
+    fn = np.sum(prediction[target == 1] == 0)
+    return np.array([[tp, fn], [fp, tn]])
+
+
+def loop_confusion_matrix(predictions, target, multilabel=False):
+    """get_confusion_matrix summing one binary matrix by class, the reference of the vectorized version"""
+    mask = loop_binarizes(predictions.numpy(), multilabel=multilabel)
+    n_classes = mask.shape[1]
+    if multilabel or n_classes == 1:
+        labels_masks = target.numpy()
+    else:
+        labels_masks = torch.nn.functional.one_hot(torch.argmax(target, axis=1), num_classes=n_classes)
+        labels_masks = labels_masks.permute(0, 3, 1, 2).numpy()
+    cms = np.zeros((2, 2), dtype=np.uint64)
+    for c in range(n_classes):
+        cms = cms + loop_binary_confusion_matrix(labels_masks[:, c, :, :].flatten(), mask[:, c, :, :].flatten())
+    return cms
+
+
+class TestBinarizes(object):
+
+    @pytest.mark.parametrize("shape", [(2, 1, 16), (2, 1, 16, 16), (2, 4, 16), (2, 4, 16, 16)])
+    @pytest.mark.parametrize("multilabel", [False, True])
+    def test_same_as_loops(self, shape, multilabel):
+
+        detection = np.random.RandomState(2020).rand(*shape).astype(np.float32)
+
+        result = binarizes(detection, multilabel=multilabel)
+        expected = loop_binarizes(detection, multilabel=multilabel)
+
+        assert result.shape == expected.shape
+        assert result.dtype == expected.dtype
+        np.testing.assert_array_equal(result, expected)
+
+
+class TestConfusionMatrix(object):
+
+    @pytest.mark.parametrize("n_classes, multilabel", [(1, False), (4, False), (4, True)])
+    def test_same_as_loops(self, n_classes, multilabel):
+
+        rng = np.random.RandomState(2020)
+        predictions = torch.from_numpy(rng.rand(2, n_classes, 16, 16).astype(np.float32))
+        target = torch.from_numpy((rng.rand(2, n_classes, 16, 16) > 0.5).astype(np.float32))
+
+        result = get_confusion_matrix(predictions, target, multilabel=multilabel)
+        expected = loop_confusion_matrix(predictions, target, multilabel=multilabel)
+
+        assert result.dtype == np.uint64
+        np.testing.assert_array_equal(result, expected)
+
+    def test_binary_same_as_boolean_indexing(self):
+
+        rng = np.random.RandomState(2020)
+        prediction = (rng.rand(1000) > 0.5).astype(np.uint8)
+        target = (rng.rand(1000) > 0.3).astype(np.uint8)
+
+        np.testing.assert_array_equal(get_binary_confusion_matrix(prediction, target),
+                                      loop_binary_confusion_matrix(prediction, target))
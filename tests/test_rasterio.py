@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from odeon.commons.rasterio import InMemoryRaster, create_patch_from_center, normalize_array_in
+
+
+class TestInMemoryRaster(object):
+
+    @pytest.fixture
+    def full_mask(self, tmp_path):
+
+        rng = np.random.RandomState(2020)
+        data = np.zeros((3, 64, 64), dtype=np.uint8)
+        data[:2] = rng.randint(0, 2, size=(2, 64, 64))
+        meta = {"driver": "GTiff", "count": 3, "height": 64, "width": 64, "dtype": "uint8",
+                "crs": "EPSG:2154", "transform": from_origin(0, 64, 1, 1)}
+        path = str(tmp_path / "full_mask.tif")
+
+        with rasterio.open(path, "w", **meta) as dst:
+            dst.write(data)
+
+        yield path
+
+    @pytest.mark.parametrize("window", [Window(8, 16, 16, 16),
+                                        Window(48, 48, 16, 16),
+                                        Window(8.5, 16.5, 16, 16),
+                                        Window(8, 16, 32, 32)])
+    def test_same_patch_as_dataset(self, full_mask, tmp_path, window):
+
+        meta = {"driver": "GTiff", "count": 3, "height": 16, "width": 16, "dtype": "uint8",
+                "crs": "EPSG:2154", "transform": from_origin(0, 64, 1, 1)}
+        from_disk = str(tmp_path / "from_disk.tif")
+        from_memory = str(tmp_path / "from_memory.tif")
+
+        create_patch_from_center(from_disk, full_mask, meta, window, Resampling.nearest)
+        with rasterio.open(full_mask) as dataset:
+            create_patch_from_center(from_memory, InMemoryRaster(dataset), meta, window, Resampling.nearest)
+
+        with rasterio.open(from_disk) as expected, rasterio.open(from_memory) as actual:
+            np.testing.assert_array_equal(actual.read(), expected.read())
+
+
+class TestNormalizeArrayIn(object):
+
+    @pytest.mark.parametrize("dtype, max_type_val", [(np.uint8, 2**8 - 1), (np.uint16, 2**16 - 1)])
+    def test_scaled_to_max_type_value(self, dtype, max_type_val):
+
+        rng = np.random.RandomState(2020)
+        array = rng.randint(0, 1000, size=(3, 32, 32)).astype(np.uint16)
+
+        expected = (array.astype(np.float64) * (max_type_val / float(array.max()))).astype(dtype)
+        result = normalize_array_in(array, dtype, max_type_val)
+
+        assert result.dtype == dtype
+        assert result.max() == max_type_val
+        np.testing.assert_array_equal(result, expected)
+
+    def test_zero_array(self):
+
+        result = normalize_array_in(np.zeros((1, 4, 4), dtype=np.uint16), np.uint8, 2**8 - 1)
+
+        assert result.dtype == np.uint8
+        np.testing.assert_array_equal(result, 0)
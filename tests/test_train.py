@@ -1,13 +1,21 @@
 import os
+from types import SimpleNamespace
 import gdal
 import numpy as np
 import pytest
 import random
+import rasterio
+import torch
 
 from torch.utils.data import DataLoader
 
+from odeon.commons.image import raster_to_ndarray_from_dataset
+from odeon.commons.metrics import get_confusion_matrix_torch
 from odeon.nn.datasets import PatchDataset
+from odeon.nn.losses import CrossEntropyWithLogitsLoss
+from odeon.nn.training_engine import TrainingEngine
 from odeon.nn.transforms import Rotation90, ToDoubleTensor, Compose
+from odeon.scripts.train import Trainer
 
 import albumentations as A
 from albumentations.pytorch.transforms import ToTensorV2
@@ -161,3 +169,91 @@ class TestTransformation(object):
             sample['image'][0, :, int(512/2) - 1, int(512/2)].numpy(),
             1/255
         )
+
+
+class TestTrainingSamples(object):
+
+    @pytest.fixture
+    def generate_sample(self):
+
+        rng = np.random.RandomState(2020)
+
+        data = rng.randint(0, 256, size=(5, 64, 64))
+        ds = gdal.GetDriverByName('GTiff').Create("/tmp/test_image.tif", 64, 64, 5, gdal.GDT_Byte)
+        for i in range(data.shape[0]):
+            tmpbnd = ds.GetRasterBand(i+1)
+            tmpbnd.WriteArray(data[i, :, :], 0, 0)
+        ds.FlushCache()
+        ds = None
+
+        classes = rng.randint(0, 3, size=(64, 64))
+        data = np.stack([classes == i for i in range(3)]).astype(np.uint8)
+        ds = gdal.GetDriverByName('GTiff').Create("/tmp/test_mask.tif", 64, 64, 3, gdal.GDT_Byte)
+        for i in range(data.shape[0]):
+            tmpbnd = ds.GetRasterBand(i+1)
+            tmpbnd.WriteArray(data[i, :, :], 0, 0)
+        ds.FlushCache()
+        ds = None
+
+        yield
+
+        os.remove("/tmp/test_image.tif")
+        os.remove("/tmp/test_mask.tif")
+
+    def test_class_index_mask(self, generate_sample):
+
+        image_files = ['/tmp/test_image.tif']
+        mask_files = ['/tmp/test_mask.tif']
+        one_hot_sample = PatchDataset(image_files, mask_files)[0]
+        index_sample = PatchDataset(image_files, mask_files, class_index_mask=True)[0]
+
+        one_hot_mask = one_hot_sample['mask'].unsqueeze(0)
+        index_mask = index_sample['mask'].unsqueeze(0)
+        assert index_mask.dtype == torch.uint8
+        np.testing.assert_array_equal(index_mask.numpy(), one_hot_mask.argmax(1).numpy())
+
+        # loss and metrics are the same with both forms of target
+        torch.manual_seed(2020)
+        logits = torch.randn(1, 3, 64, 64)
+        loss = CrossEntropyWithLogitsLoss()
+        assert torch.allclose(loss(logits, one_hot_mask), loss(logits, index_mask))
+        np.testing.assert_array_equal(get_confusion_matrix_torch(logits, one_hot_mask).numpy(),
+                                      get_confusion_matrix_torch(logits, index_mask).numpy())
+
+    def test_normalize_on_device(self, generate_sample):
+
+        image_files = ['/tmp/test_image.tif']
+        mask_files = ['/tmp/test_mask.tif']
+        normalized = PatchDataset(image_files, mask_files)[0]['image']
+        raw = PatchDataset(image_files, mask_files, normalize=False)[0]['image']
+
+        assert raw.dtype == torch.uint8
+        engine = SimpleNamespace(device="cpu", memory_format=torch.contiguous_format)
+        np.testing.assert_allclose(TrainingEngine.to_device_image(engine, raw.unsqueeze(0))[0].numpy(),
+                                   normalized.numpy(), rtol=1e-6)
+
+    def test_read_patch(self, generate_sample):
+
+        dataset = PatchDataset(['/tmp/test_image.tif'], ['/tmp/test_mask.tif'])
+
+        img = dataset.read_patch('/tmp/test_image.tif', [1, 3])
+        with rasterio.open('/tmp/test_image.tif') as src:
+            expected, _ = raster_to_ndarray_from_dataset(src, src.width, src.height, src.res, [1, 3])
+
+        assert img.shape == (64, 64, 2)
+        assert img.dtype == np.uint8
+        np.testing.assert_array_equal(img, expected)
+
+
+def test_read_csv_sample_file(tmp_path):
+
+    csv_file = tmp_path / "train.csv"
+    csv_file.write_text("img/a.tif,msk/a.tif\nNA,null\n0012,1e3\n")
+    empty_file = tmp_path / "empty.csv"
+    empty_file.write_text("")
+    trainer = Trainer.__new__(Trainer)
+
+    # every line is a sample, paths are kept as written
+    assert trainer.read_csv_sample_file(str(csv_file)) == (["img/a.tif", "NA", "0012"],
+                                                           ["msk/a.tif", "null", "1e3"])
+    assert trainer.read_csv_sample_file(str(empty_file)) == ([], [])